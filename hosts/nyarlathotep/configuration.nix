@@ -99,6 +99,7 @@ in
   systemd.tmpfiles.rules = [
     "d ${certdir} - root root -"
     "d ${basedir}/var/lib/caddy 700 caddy caddy -"
+    "d ${basedir}/var/lib/hledger-export-to-victoriametrics 700 barrucadu users -"
   ];
 
 
@@ -115,19 +116,19 @@ in
   };
   nixfiles.restic-backups.backups.torrents = {
     prepareCommand = ''
-      ${pkgs.python3}/bin/python3 ${./jobs/restic-prepare--hardlink-torrent-files.py} > hardlink-torrent-files.sh
+      MANIFEST_FILE="$CACHE_DIRECTORY/hardlink-torrent-files.json.gz" ${pkgs.python3}/bin/python3 ${./jobs/restic-prepare--hardlink-torrent-files.py} --compact > hardlink-torrent-files.list
     '';
     paths = [
-      "hardlink-torrent-files.sh"
+      "hardlink-torrent-files.list"
       "/mnt/nas/torrents/watch"
     ];
   };
   nixfiles.restic-backups.backups.youtube = {
     prepareCommand = ''
-      ${pkgs.python3}/bin/python3 ${./jobs/restic-prepare--fetch-youtube.py} > fetch-youtube.sh
+      ${pkgs.python3}/bin/python3 ${./jobs/restic-prepare--fetch-youtube.py} --batch > fetch-youtube.jsonl
     '';
     paths = [
-      "fetch-youtube.sh"
+      "fetch-youtube.jsonl"
     ];
   };
   sops.secrets."nixfiles/restic-backups/env" = { };
@@ -516,22 +517,26 @@ in
 
   systemd.services.hledger-export-to-victoriametrics = {
     description = "Export personal finance data to VictoriaMetrics";
-    startAt = "daily";
+    wantedBy = [ "multi-user.target" ];
+    after = [ "victoriametrics.service" ];
     path = with pkgs; [ hledger ];
     serviceConfig = {
       ExecStart =
-        let python = pkgs.python3.withPackages (ps: [ ps.requests ]);
-        in "${python}/bin/python3 ${pkgs.writeText "hledger-export-to-victoriametrics.py" (fileContents ./jobs/hledger-export-to-victoriametrics.py)}";
+        let python = pkgs.python3.withPackages (ps: [ ps.numpy ps.requests ]);
+        in "${python}/bin/python3 ${pkgs.writeText "hledger-export-to-victoriametrics.py" (fileContents ./jobs/hledger-export-to-victoriametrics.py)} --watch";
       User = "barrucadu";
       Group = "users";
+      Restart = "always";
+      RestartSec = "30s";
     };
     environment = {
+      CACHE_FILE = "${basedir}/var/lib/hledger-export-to-victoriametrics/journals.pickle.gz";
       LEDGER_FILE = "/home/barrucadu/s/ledger/combined.journal";
+      METRIC_PROCESSES = "4";
+      STATE_FILE = "${basedir}/var/lib/hledger-export-to-victoriametrics/state.json";
       VICTORIAMETRICS_URI = "http://${config.services.victoriametrics.listenAddress}";
     };
   };
-  # also reload data after boot
-  systemd.timers.hledger-export-to-victoriametrics.timerConfig.OnBootSec = "5m";
 
   services.victoriametrics = {
     enable = true;
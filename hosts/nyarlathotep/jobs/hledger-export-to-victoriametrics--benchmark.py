@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+"""Benchmark hledger-export-to-victoriametrics against a synthetic journal.
+
+Generates `hledger prices` and `hledger print -O csv` output, feeds it
+through each stage of the exporter, and writes the wall time, peak memory,
+and sample count of every stage to a JSON file.  Neither hledger nor
+VictoriaMetrics is needed.
+"""
+
+import argparse
+import csv
+import datetime
+import importlib.util
+import io
+import json
+import math
+import os
+import platform
+import random
+import resource
+import sys
+import time
+import tracemalloc
+
+EXPORTER_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "hledger-export-to-victoriametrics.py"
+)
+
+TOP_LEVEL_ACCOUNTS = ["assets", "equity", "expenses", "income", "liabilities"]
+
+CSV_FIELDS = [
+    "txnidx",
+    "date",
+    "date2",
+    "status",
+    "code",
+    "description",
+    "comment",
+    "account",
+    "amount",
+    "commodity",
+    "credit",
+    "debit",
+    "posting-status",
+    "posting-comment",
+]
+
+
+def load_exporter():
+    """Import the exporter script as a module."""
+
+    spec = importlib.util.spec_from_file_location("exporter", EXPORTER_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def account_names(count, depth, prefix=""):
+    """Generate `count` distinct account names, `depth` levels deep, which
+    share their superaccounts as evenly as possible.
+    """
+
+    levels = max(0, depth - 2)
+    width = math.ceil(count ** (1 / levels)) if levels else 1
+
+    names = []
+    for i in range(count):
+        parts = [TOP_LEVEL_ACCOUNTS[i % len(TOP_LEVEL_ACCOUNTS)]]
+        parts.extend(f"g{(i // width**level) % width}" for level in range(levels))
+        parts.append(f"a{i}")
+        names.append(prefix + ":".join(parts[-depth:]))
+    return names
+
+
+def generate_journal(args, rnd, prefix=""):
+    """Generate `(price lines, posting lines)` in the format output by
+    hledger.  The first currency is always GBP.
+    """
+
+    start = datetime.date(2000, 1, 1)
+    days = 365 * args.years
+
+    accounts = account_names(args.accounts, args.depth, prefix)
+    currencies = ["£"] + [f"{prefix}C{n:02}" for n in range(1, args.currencies)]
+
+    prices = []
+    rates = {currency: rnd.uniform(0.5, 2) for currency in currencies[1:]}
+    for day in range(0, days, args.price_interval):
+        date = (start + datetime.timedelta(days=day)).isoformat()
+        for currency, rate in rates.items():
+            rates[currency] = max(0.0001, rate * rnd.uniform(0.98, 1.02))
+            prices.append(f"P {date} {currency} £{rates[currency]:,.4f}\n")
+
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(CSV_FIELDS)
+    txnidx = 0
+    for day in range(days):
+        date = (start + datetime.timedelta(days=day)).isoformat()
+        for _ in range(rnd.randint(0, args.postings_per_day)):
+            txnidx += 1
+            status = rnd.choice(["", "!", "*"])
+            currency = rnd.choice(currencies)
+            amount = f"{rnd.randint(1, 500000) / 100:,.2f}"
+            source, destination = rnd.sample(accounts, 2)
+            for account, credit, debit in [
+                (source, amount, ""),
+                (destination, "", amount),
+            ]:
+                writer.writerow(
+                    [txnidx, date, "", status, "", "", "", account, ""]
+                    + [currency, credit, debit, "", ""]
+                )
+
+    return prices, out.getvalue().splitlines(keepends=True)
+
+
+def count_samples(result):
+    """Return `(series, samples)` in a stage's result, if it has any."""
+
+    if isinstance(result, dict) and all(isinstance(v, dict) for v in result.values()):
+        counts = [count_samples(values) for values in result.values()]
+        return sum(c[0] for c in counts), sum(c[1] for c in counts)
+    if isinstance(result, dict):
+        series = [s for s in result.values() if hasattr(s, "timestamps")]
+        if len(series) == len(result):
+            return len(series), sum(len(s) for s in series)
+    if hasattr(result, "keys") and hasattr(result, "dates"):
+        return len(result.keys), len(result.keys) * len(result.dates)
+    return None, None
+
+
+class Stages:
+    """Time each stage, keeping the fastest of several runs, and record its
+    memory use and output size.
+    """
+
+    def __init__(self, repeat, trace_memory):
+        self.repeat = repeat
+        self.trace_memory = trace_memory
+        self.results = []
+
+    def run(self, name, function, *args):
+        best = None
+        for _ in range(self.repeat):
+            if self.trace_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            result = function(*args)
+            seconds = time.perf_counter() - start
+            if self.trace_memory:
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            best = seconds if best is None else min(best, seconds)
+
+        series, samples = count_samples(result)
+        self.results.append(
+            {
+                "stage": name,
+                "seconds": best,
+                "peak_traced_bytes": peak if self.trace_memory else None,
+                "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                * 1024,
+                "series": series,
+                "samples": samples,
+            }
+        )
+        print(
+            f"{name:46} {best:9.3f}s"
+            + (f" {samples:>12,} samples" if samples is not None else ""),
+            file=sys.stderr,
+        )
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--years", type=int, default=10)
+    parser.add_argument("--depth", type=int, default=3, help="levels per account")
+    parser.add_argument("--accounts", type=int, default=50, help="leaf accounts")
+    parser.add_argument("--currencies", type=int, default=4, help="including GBP")
+    parser.add_argument("--postings-per-day", type=int, default=10, help="on average")
+    parser.add_argument("--price-interval", type=int, default=1, help="in days")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=1, help="keep the fastest run")
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="record per-stage peak memory with tracemalloc (slows every stage)",
+    )
+    parser.add_argument("--output", default="benchmark.json")
+    args = parser.parse_args()
+
+    exporter = load_exporter()
+    rnd = random.Random(args.seed)
+
+    price_lines, posting_lines = generate_journal(args, rnd)
+    synthetic_price_lines, synthetic_posting_lines = generate_journal(
+        args, rnd, prefix="syn:"
+    )
+
+    stages = Stages(args.repeat, args.trace_memory)
+    start = time.perf_counter()
+
+    prices = stages.run("read_prices", exporter.read_prices, price_lines)
+    postings = stages.run(
+        "read_postings", lambda: list(exporter.read_postings(posting_lines))
+    )
+
+    txnids_by_timestamp = {}
+    stages.run(
+        "group_transactions",
+        lambda: list(exporter.group_transactions(postings, txnids_by_timestamp)),
+    )
+    credits_debits = stages.run(
+        "preprocess_group_credits_debits",
+        exporter.preprocess_group_credits_debits,
+        postings,
+    )
+
+    synthetic_prices = exporter.read_prices(synthetic_price_lines)
+    synthetic_credits_debits = stages.run(
+        "preprocess_group_credits_debits (only_leaves)",
+        exporter.preprocess_group_credits_debits,
+        list(exporter.read_postings(synthetic_posting_lines)),
+        True,
+    )
+    stages.run("preprocess_prices", exporter.preprocess_prices, prices, credits_debits)
+
+    journals = {
+        "prices": prices,
+        "credits_debits": credits_debits,
+        "transaction_counts": {
+            ts: {k: len(ids) for k, ids in vs.items()}
+            for ts, vs in txnids_by_timestamp.items()
+        },
+        "synthetic_prices": synthetic_prices,
+        "synthetic_credits_debits": synthetic_credits_debits,
+    }
+    for names, (function, *function_args) in exporter.metric_families(journals).items():
+        name = ", ".join(names) if isinstance(names, tuple) else names
+        stages.run(name, function, *function_args)
+
+    report = {
+        "parameters": vars(args),
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": getattr(exporter.numpy, "__version__", None),
+        },
+        "inputs": {
+            "price_lines": len(price_lines),
+            "postings": len(posting_lines) - 1,
+        },
+        "total_seconds": time.perf_counter() - start,
+        "stages": stages.results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
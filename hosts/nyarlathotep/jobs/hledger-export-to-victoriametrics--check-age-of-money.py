@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+"""Check hledger-export-to-victoriametrics's age of money against the
+original list-based algorithm.
+
+Generates random histories of daily net changes, including overdrafts,
+withdrawals of exactly the balance or exactly up to a bucket boundary, and
+deposits after an account has been emptied, and compares the ages from
+`FifoBuckets` and from `metric_hledger_accounts` (with and without NumPy)
+with those from the original algorithm.
+"""
+
+import argparse
+import array
+import importlib.util
+import os
+import random
+import sys
+
+EXPORTER_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "hledger-export-to-victoriametrics.py"
+)
+
+
+def load_exporter():
+    """Import the exporter script as a module."""
+
+    spec = importlib.util.spec_from_file_location("exporter", EXPORTER_FILE)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def original_ages(timestamps, deltas):
+    """The age of money after each delta, as computed before `FifoBuckets`:
+    every bucket holds the running total of deposits, and a withdrawal
+    subtracts from all of them and drops the ones it empties.
+    """
+
+    ages = []
+    buckets = []
+    for timestamp, delta in zip(timestamps, deltas):
+        if delta > 0:
+            if len(buckets) == 0:
+                buckets = [(timestamp, delta)]
+            else:
+                _, latest_value = buckets[-1]
+                buckets.append((timestamp, latest_value + delta))
+        elif delta < 0:
+            buckets = [(t, value + delta) for t, value in buckets if value > -delta]
+        if len(buckets) == 0:
+            ages.append(0)
+        else:
+            first_timestamp, _ = buckets[0]
+            ages.append(int((timestamp - first_timestamp) / 86400000))
+    return ages
+
+
+def fifo_bucket_ages(exporter, timestamps, deltas):
+    """The age of money after each delta, using `FifoBuckets`."""
+
+    buckets = exporter.FifoBuckets()
+    ages = []
+    for timestamp, delta in zip(timestamps, deltas):
+        if delta > 0:
+            buckets.deposit(timestamp, delta)
+        elif delta < 0:
+            buckets.withdraw(-delta)
+        ages.append(buckets.age(timestamp))
+    return ages
+
+
+def generate_deltas(rnd, length):
+    """Generate `length` daily net changes for one account.
+
+    Withdrawals are picked to hit the interesting cases often: taking out
+    exactly the balance, exactly the deposits up to some bucket, more than
+    the balance, or a random part of it.
+    """
+
+    deltas = []
+    deposits = []
+    balance = 0
+    for _ in range(length):
+        choice = rnd.random()
+        if choice < 0.15:
+            delta = 0
+        elif choice < 0.55 or balance <= 0:
+            delta = rnd.randint(1, 1000)
+            deposits.append(delta)
+        elif choice < 0.65:
+            delta = -balance
+        elif choice < 0.8 and deposits:
+            delta = -sum(deposits[: rnd.randint(1, len(deposits))])
+        elif choice < 0.9:
+            delta = -(balance + rnd.randint(1, 1000))
+        else:
+            delta = -rnd.randint(1, balance)
+
+        if delta < 0:
+            # track what a FIFO still holds, to aim at bucket boundaries
+            remaining = -delta
+            while deposits and remaining >= deposits[0]:
+                remaining -= deposits.pop(0)
+            if deposits:
+                deposits[0] -= remaining
+        balance = max(0, balance + delta)
+        deltas.append(delta)
+    return deltas
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--histories", type=int, default=200)
+    parser.add_argument("--length", type=int, default=500, help="days per history")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    exporter = load_exporter()
+    rnd = random.Random(args.seed)
+
+    dates = []
+    day = exporter.civil_to_day(2000, 1, 1)
+    for _ in range(args.length):
+        day += rnd.choice([1, 1, 1, 2, 7, 30])
+        dates.append(day)
+    timestamps = [exporter.day_to_timestamp(day) for day in dates]
+
+    all_deltas = [generate_deltas(rnd, args.length) for _ in range(args.histories)]
+    expected = [original_ages(timestamps, deltas) for deltas in all_deltas]
+
+    failures = []
+
+    def check(name, ages):
+        bad = [k for k in range(args.histories) if ages[k] != expected[k]]
+        print(f"{'ok  ' if not bad else 'FAIL'} {name}")
+        if bad:
+            print(f"     history {bad[0]}: deltas {all_deltas[bad[0]]}")
+            failures.append(name)
+
+    check(
+        "FifoBuckets",
+        [fifo_bucket_ages(exporter, timestamps, deltas) for deltas in all_deltas],
+    )
+
+    keys = [(("account", f"a{k}"), ("currency", "£")) for k in range(args.histories)]
+    credit = array.array("q")
+    debit = array.array("q")
+    for deltas in all_deltas:
+        credit.extend(max(0, -delta) for delta in deltas)
+        debit.extend(max(0, delta) for delta in deltas)
+    credits_debits = exporter.CreditsDebits(dates, keys, [1] * len(keys), credit, debit)
+
+    numpy = exporter.numpy
+    for name, module in [("with NumPy", numpy), ("without NumPy", None)]:
+        if name == "with NumPy" and numpy is None:
+            print(f"skip metric_hledger_accounts ({name}): NumPy isn't installed")
+            continue
+        exporter.numpy = module
+        ages = exporter.metric_hledger_accounts(credits_debits)["hledger_age_of_money"]
+        check(
+            f"metric_hledger_accounts ({name})",
+            [ages[key].values for key in keys],
+        )
+    exporter.numpy = numpy
+
+    if failures:
+        sys.exit(f"{len(failures)} checks failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+
+"""Check the upload stage of hledger-export-to-victoriametrics against a stub
+VictoriaMetrics server.
+
+Replays a small snapshot through the exporter while the stub fails some of
+its requests, and checks that transient failures are retried, that client
+errors are not, that series which still fail are reported and rebuilt by the
+next run, and that no more than `UPLOAD_CONCURRENCY` imports are in flight at
+once.  Neither hledger nor VictoriaMetrics is needed.
+"""
+
+import argparse
+import collections
+import gzip
+import http.server
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+EXPORTER_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "hledger-export-to-victoriametrics.py"
+)
+
+# metric name => number of series
+SNAPSHOT_METRICS = {"check_a": 3, "check_b": 2}
+SNAPSHOT_SAMPLES = 10
+
+UPLOAD_RETRIES = 2
+
+
+def parse_selector(selector):
+    """Parse `name{label="value",...}` into `(name, {label: value})`."""
+
+    name, _, labels = selector.partition("{")
+    return (
+        name,
+        {
+            k: re.sub(r"\\(.)", r"\1", v)
+            for k, v in re.findall(r'(\w+)="((?:[^"\\]|\\.)*)"', labels)
+        },
+    )
+
+
+class StubVictoriaMetrics:
+    """Just enough of the VictoriaMetrics HTTP API for the exporter: JSON
+    imports, deleting series, and resetting the cache.
+
+    `fail(path, body)` can return an HTTP status to fail a request with, and
+    `delay` makes every import take that many seconds.  `max_in_flight` is
+    the most imports which have been handled at once.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # samples :: (name, frozenset(labels)) => timestamp => count
+        self.samples = {}
+        # requests :: [(path, body, status)]
+        self.requests = []
+        self.fail = lambda path, body: None
+        self.delay = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.handle_request(b"")
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                self.handle_request(body)
+
+            def handle_request(self, body):
+                url = urllib.parse.urlparse(self.path)
+                status = stub.request(
+                    url.path, urllib.parse.parse_qs(url.query), body.decode("utf-8")
+                )
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.uri = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def request(self, path, query, body):
+        if path == "/api/v1/import":
+            with self.lock:
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            time.sleep(self.delay)
+            with self.lock:
+                self.in_flight -= 1
+
+        status = self.fail(path, body) or self.apply(path, query, body)
+        with self.lock:
+            self.requests.append((path, body, status))
+        return status
+
+    def apply(self, path, query, body):
+        with self.lock:
+            if path == "/api/v1/import":
+                for line in body.splitlines():
+                    row = json.loads(line)
+                    labels = row["metric"]
+                    key = (labels.pop("__name__"), frozenset(labels.items()))
+                    series = self.samples.setdefault(key, collections.Counter())
+                    series.update(row["timestamps"])
+            elif path == "/api/v1/admin/tsdb/delete_series":
+                for selector in query["match[]"]:
+                    name, labels = parse_selector(selector)
+                    for key in list(self.samples):
+                        if key[0] == name and set(labels.items()) <= key[1]:
+                            del self.samples[key]
+            elif path != "/internal/resetRollupResultCache":
+                return 404
+        return 204
+
+    def reset(self):
+        self.requests = []
+        self.fail = lambda path, body: None
+        self.delay = 0
+        self.max_in_flight = 0
+
+    def imports(self, metric=None):
+        """Return the bodies of import requests, and their statuses,
+        optionally only those which include the given metric.
+        """
+
+        return [
+            (body, status)
+            for path, body, status in self.requests
+            if path == "/api/v1/import"
+            and (metric is None or f'"__name__":"{metric}"' in body)
+        ]
+
+    def series(self, metric):
+        """Return `{labels: {timestamp: count}}` for a metric."""
+
+        return {
+            labels: dict(counts)
+            for (name, labels), counts in self.samples.items()
+            if name == metric
+        }
+
+
+class Checker:
+    """Run the exporter against the stub, and collect failed checks."""
+
+    def __init__(self, workdir, verbose):
+        self.stub = StubVictoriaMetrics()
+        self.workdir = workdir
+        self.verbose = verbose
+        self.snapshot_file = os.path.join(workdir, "snapshot.ndjson.gz")
+        self.state_file = os.path.join(workdir, "state.json")
+        self.failures = []
+
+        with gzip.open(self.snapshot_file, "wt", encoding="utf-8") as f:
+            for name, count in SNAPSHOT_METRICS.items():
+                for n in range(count):
+                    payload = {
+                        "metric": {"__name__": name, "n": str(n)},
+                        "values": [n + i / 4 for i in range(SNAPSHOT_SAMPLES)],
+                        "timestamps": [i * 1000 for i in range(SNAPSHOT_SAMPLES)],
+                    }
+                    f.write(json.dumps(payload) + "\n")
+
+    def run_exporter(self, **env):
+        """Replay the snapshot, returning the exporter's exit code."""
+
+        result = subprocess.run(
+            [sys.executable, EXPORTER_FILE, f"--replay={self.snapshot_file}"],
+            env=dict(
+                os.environ,
+                VICTORIAMETRICS_URI=self.stub.uri,
+                STATE_FILE=self.state_file,
+                UPLOAD_BATCH_SERIES="1",
+                UPLOAD_RETRIES=str(UPLOAD_RETRIES),
+                UPLOAD_RETRY_DELAY="0.01",
+                **env,
+            ),
+            capture_output=True,
+            text=True,
+        )
+        if self.verbose:
+            print(result.stdout + result.stderr, end="", file=sys.stderr)
+        return result.returncode
+
+    def check(self, name, ok, detail=""):
+        print(
+            f"{'ok  ' if ok else 'FAIL'} {name}"
+            + (f": {detail}" if detail and not ok else "")
+        )
+        if not ok:
+            self.failures.append(name)
+
+    def check_uploaded(self, name, metric):
+        """Check every series of a metric is there, with each sample once."""
+
+        series = self.stub.series(metric)
+        expected = {i * 1000: 1 for i in range(SNAPSHOT_SAMPLES)}
+        self.check(
+            name,
+            len(series) == SNAPSHOT_METRICS[metric]
+            and all(counts == expected for counts in series.values()),
+            f"{metric} has {series}",
+        )
+
+    def fresh_start(self):
+        self.stub.reset()
+        self.stub.samples.clear()
+        if os.path.exists(self.state_file):
+            os.remove(self.state_file)
+
+    def transient_failures(self):
+        self.fresh_start()
+        failed = []
+
+        def fail(path, body):
+            if path == "/api/v1/import" and len(failed) < UPLOAD_RETRIES:
+                failed.append(body)
+                return 503
+
+        self.stub.fail = fail
+        code = self.run_exporter()
+
+        self.check("transient: exits successfully", code == 0, f"exit code {code}")
+        for metric in SNAPSHOT_METRICS:
+            self.check_uploaded("transient: retried series uploaded once", metric)
+
+    def persistent_failures(self):
+        self.fresh_start()
+        self.stub.fail = lambda path, body: (
+            503 if '"__name__":"check_b"' in body else None
+        )
+        code = self.run_exporter()
+
+        self.check("persistent: exits with an error", code != 0, f"exit code {code}")
+        self.check_uploaded("persistent: other series uploaded", "check_a")
+        attempts = len(self.stub.imports("check_b"))
+        expected = SNAPSHOT_METRICS["check_b"] * (UPLOAD_RETRIES + 1)
+        self.check(
+            "persistent: each failed batch retried",
+            attempts == expected,
+            f"{attempts} attempts, expected {expected}",
+        )
+
+        with open(self.state_file) as f:
+            state = json.load(f)["series"]
+        self.check(
+            "persistent: failed series rebuilt next time",
+            all(
+                (v["last_timestamp"] is None) == k.startswith("check_b{")
+                for k, v in state.items()
+                if k.startswith("check_")
+            ),
+            json.dumps(state),
+        )
+
+        self.stub.reset()
+        code = self.run_exporter()
+
+        self.check("persistent: next run succeeds", code == 0, f"exit code {code}")
+        self.check_uploaded("persistent: failed series uploaded once", "check_b")
+        self.check(
+            "persistent: other series not re-sent",
+            not self.stub.imports("check_a"),
+        )
+
+    def client_errors(self):
+        self.fresh_start()
+        self.stub.fail = lambda path, body: (
+            400 if '"__name__":"check_b"' in body else None
+        )
+        code = self.run_exporter()
+
+        self.check("client error: exits with an error", code != 0, f"exit code {code}")
+        attempts = len(self.stub.imports("check_b"))
+        expected = SNAPSHOT_METRICS["check_b"]
+        self.check(
+            "client error: not retried",
+            attempts == expected,
+            f"{attempts} attempts, expected {expected}",
+        )
+
+    def concurrency(self):
+        self.fresh_start()
+        self.stub.delay = 0.2
+        code = self.run_exporter(UPLOAD_CONCURRENCY="2")
+
+        self.check("concurrency: exits successfully", code == 0, f"exit code {code}")
+        self.check(
+            "concurrency: imports limited to UPLOAD_CONCURRENCY",
+            self.stub.max_in_flight == 2,
+            f"{self.stub.max_in_flight} in flight at once",
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the exporter's output"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        checker = Checker(workdir, args.verbose)
+        checker.transient_failures()
+        checker.persistent_failures()
+        checker.client_errors()
+        checker.concurrency()
+
+    if checker.failures:
+        sys.exit(f"{len(checker.failures)} checks failed")
+
+
+if __name__ == "__main__":
+    main()
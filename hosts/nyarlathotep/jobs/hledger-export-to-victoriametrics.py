@@ -1,90 +1,305 @@
 #!/usr/bin/env python3
 
-import calendar
+import array
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
 import csv
-import datetime
+import ctypes
+import glob
+import gzip
+import hashlib
 import io
+import itertools
+import json
+import multiprocessing
 import os
+import pickle
+import random
+import re
+import select
+import struct
 import subprocess
 import sys
+import time
 
-from decimal import Decimal
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def flag_value(flag):
+    """The value of a `--flag=value` argument, or `None`."""
+
+    for arg in sys.argv:
+        if arg.startswith(f"{flag}="):
+            return arg[len(flag) + 1 :]
+    return None
 
 
 DRY_RUN = "--dry-run" in sys.argv
 
-if not DRY_RUN:
+# Write every series to a snapshot file, as gzipped `/api/v1/import` JSON
+# lines, rather than uploading them
+SNAPSHOT_FILE = flag_value("--snapshot")
+
+# Upload the series from a snapshot file, rather than running hledger
+REPLAY_FILE = flag_value("--replay")
+
+# Keep running, and export again whenever the journals change
+WATCH = "--watch" in sys.argv
+
+# In watch mode, wait for this many seconds without any changes before
+# exporting, so a burst of writes only triggers one export
+WATCH_DEBOUNCE = float(os.getenv("WATCH_DEBOUNCE", "2"))
+
+# In watch mode, retry a failed export after this many seconds, doubling
+# after each failure up to `WATCH_RETRY_MAX_DELAY`, even if the journals
+# haven't changed
+WATCH_RETRY_DELAY = float(os.getenv("WATCH_RETRY_DELAY", "30"))
+WATCH_RETRY_MAX_DELAY = float(os.getenv("WATCH_RETRY_MAX_DELAY", "3600"))
+
+# Ignore any saved state or cache: re-run hledger, and delete and re-upload
+# every series
+FULL_REBUILD = "--full-rebuild" in sys.argv
+
+# The uploading side is only needed when run as a script: the benchmark
+# imports this file to get at the metric functions.
+if __name__ == "__main__" and not DRY_RUN and SNAPSHOT_FILE is None:
     import requests
 
     VICTORIAMETRICS_URI = os.environ["VICTORIAMETRICS_URI"]
 
+    SESSION = requests.Session()
+
 YEAR_OFFSET = int(os.getenv("YEAR_OFFSET", "0"))
 
-DOB = datetime.datetime(1991 - YEAR_OFFSET, 9, 9)
+# Where to record what has been exported, so the next run only needs to send
+# what has changed.  If unset, every run is a full rebuild.
+STATE_FILE = os.getenv("STATE_FILE")
+STATE_VERSION = 1
+
+# Where to cache the preprocessed journals, to skip running hledger if they
+# haven't changed.  If unset, hledger is always run.
+CACHE_FILE = os.getenv("CACHE_FILE")
+CACHE_VERSION = 2
+
+# Formats which can be given explicitly in an `include` directive
+HLEDGER_READERS = ["journal", "timeclock", "timedot", "csv", "ssv", "tsv", "rules"]
+
+# Report FX rates at every date ("dense"), or only when they change
+# ("changes")
+DENSE_FX_RATES = os.getenv("FX_RATE_SAMPLES", "dense") != "changes"
+
+# Compute metric families in a pool of this many processes, uploading each as
+# soon as it's done.  If 1, they're computed one by one in this process.
+METRIC_PROCESSES = int(os.getenv("METRIC_PROCESSES", "1"))
+
+# The metric families which only depend on the synthetic balances journal:
+# all the others only depend on the main journal
+SYNTHETIC_FAMILIES = ["hledger_synthetic_balance", "hledger_synthetic_balance_target"]
+
+# If set, drop samples which repeat the previous value, but keep at least one
+# sample every this many days, so a query lookback at least this long still
+# sees flat lines.  Unset (or 0) uploads every sample.
+SAMPLE_HEARTBEAT_DAYS = int(os.getenv("SAMPLE_HEARTBEAT_DAYS", "0"))
+
+# Limits on the size of a single `/api/v1/import` request
+UPLOAD_BATCH_SERIES = int(os.getenv("UPLOAD_BATCH_SERIES", "1000"))
+UPLOAD_BATCH_BYTES = int(os.getenv("UPLOAD_BATCH_BYTES", str(16 * 1024 * 1024)))
+
+# Number of import requests in flight at once
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "4"))
+
+# How often to retry a failed request to VictoriaMetrics, waiting
+# `UPLOAD_RETRY_DELAY * 2**n` seconds (plus some jitter) before retry `n`, and
+# how long to wait for a response
+UPLOAD_RETRIES = int(os.getenv("UPLOAD_RETRIES", "5"))
+UPLOAD_RETRY_DELAY = float(os.getenv("UPLOAD_RETRY_DELAY", "1"))
+UPLOAD_TIMEOUT = float(os.getenv("UPLOAD_TIMEOUT", "300"))
+
+# Wire format for uploads: "json", "csv", or "prometheus"
+UPLOAD_FORMAT = os.getenv("UPLOAD_FORMAT", "json")
+
+DOB = (1991 - YEAR_OFFSET, 9, 9)
 
 
 def hledger_command(args):
-    """Run a hledger command, throw an error if it fails, and return the
-    stdout.
+    """Run a hledger command and yield its stdout line by line, as it is
+    produced.  Throws an error at the end if the command fails.
     """
 
     real_args = ["hledger"]
     real_args.extend(args)
 
-    proc = subprocess.run(real_args, check=True, capture_output=True)
-    return proc.stdout.decode("utf-8")
+    with subprocess.Popen(real_args, stdout=subprocess.PIPE) as proc:
+        yield from io.TextIOWrapper(proc.stdout, encoding="utf-8", newline="")
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, real_args)
+
+
+def synthetic_journal_file():
+    """The synthetic balances file, which lives next to the main journal."""
+
+    dirname, _ = os.path.split(os.getenv("LEDGER_FILE"))
+    return os.path.join(dirname, "synthetic-balances.journal")
 
 
 def synthetic_command(args):
     """Wrapper for `hledger_command` that runs the command against the synthetic
     balances file."""
 
-    dirname, _ = os.path.split(os.getenv("LEDGER_FILE"))
-    args.extend(["-I", "-f", os.path.join(dirname, "synthetic-balances.journal")])
+    args.extend(["-I", "-f", synthetic_journal_file()])
 
     return hledger_command(args)
 
 
-def offset_date(date, years):
-    """Subtract `365*years` days from `YYYY-MM-DD` and return a string.
+def civil_to_day(year, month, day):
+    """Turn a calendar date into a day number (days since 1970-01-01).
 
-    This is useful for forecasting as VictoriaMetrics only allows data up to 2
-    days in the future, so instead a forecast can be shunted back so it fits
-    into the past.
+    See http://howardhinnant.github.io/date_algorithms.html
     """
 
-    date = datetime.datetime.strptime(date, "%Y-%m-%d")
-    delta = datetime.timedelta(days=365 * years)
-    return (date - delta).strftime("%Y-%m-%d")
+    if month <= 2:
+        year -= 1
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month - 3 if month > 2 else month + 9) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
 
+def day_to_civil(day):
+    """Turn a day number into a `(year, month, day)` calendar date.
 
-def offset_price_date(line, years):
-    """Apply a year offset to the date."""
+    See http://howardhinnant.github.io/date_algorithms.html
+    """
 
-    p, date, cur, val = line.split()
-    date = offset_date(date, years)
-    return f"{p} {date} {cur} {val}"
+    day += 719468
+    era = day // 146097
+    day_of_era = day - era * 146097
+    year_of_era = (
+        day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096
+    ) // 365
+    day_of_year = day_of_era - (
+        365 * year_of_era + year_of_era // 4 - year_of_era // 100
+    )
+    shifted_month = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * shifted_month + 2) // 5 + 1
+    month = shifted_month + 3 if shifted_month < 10 else shifted_month - 9
+    year = year_of_era + era * 400
+    return (year + 1 if month <= 2 else year, month, day)
 
 
-def offset_posting_date(posting, years):
-    """Apply a year offset to the date."""
+def parse_date(date, years=0):
+    """Turn `YYYY-MM-DD` into a day number, subtracting `365*years` days.
 
-    posting["date"] = offset_date(posting["date"], years)
-    return posting
+    The offset is useful for forecasting as VictoriaMetrics only allows data
+    up to 2 days in the future, so instead a forecast can be shunted back so
+    it fits into the past.
+    """
 
+    day = civil_to_day(int(date[0:4]), int(date[5:7]), int(date[8:10]))
+    return day - 365 * years
 
-def date_to_timestamp(date):
-    """Turn `YYYY-MM-DD` into a UNIX timestamp at millisecond resolution,
+
+def day_to_timestamp(day):
+    """Turn a day number into a UNIX timestamp at millisecond resolution,
     at midnight UTC.
     """
 
-    parsed = datetime.datetime.strptime(date, "%Y-%m-%d")
-    return calendar.timegm(parsed.timetuple()) * 1000
+    return day * 86400000
+
+
+def read_prices(lines):
+    """Parse `hledger prices` output into a list of `(day, currency,
+    (value, places))` GBP prices, with the year offset applied.
+    """
+
+    prices = []
+    for line in lines:
+        _, date, currency, gbp_price = line.split()
+        prices.append(
+            (parse_date(date, YEAR_OFFSET), currency, parse_amount(gbp_price[1:]))
+        )
+    return prices
+
+
+def read_postings(lines):
+    """Parse `hledger print -O csv` output into a stream of postings, with
+    the date turned into a day number and the year offset applied.
+    """
+
+    for row in csv.DictReader(lines):
+        row["date"] = parse_date(row["date"], YEAR_OFFSET)
+        yield row
+
+
+def parse_amount(amount):
+    """Parse a decimal like `-1,234.56` into `(value, places)`, where the
+    amount is `value / 10**places`.
+    """
+
+    whole, _, fraction = amount.replace(",", "").partition(".")
+    return (int(whole + fraction), len(fraction))
+
+
+class Series:
+    """The samples of one series, as parallel lists of ascending timestamps
+    and values.
+
+    Values are fixed-point, the real value being `value / unit`.  They are
+    only turned into floats when serialised.
+    """
+
+    def __init__(self, timestamps, values, unit=1):
+        self.timestamps = timestamps
+        self.values = values
+        self.unit = unit
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def real_values(self):
+        """The values as floats, or as they are if they are not scaled."""
+
+        if self.unit == 1:
+            return self.values
+        unit = self.unit
+        return [value / unit for value in self.values]
+
+    def compact(self, max_interval):
+        """Drop samples equal to the one before, unless it's been
+        `max_interval` since the last sample kept.
+
+        Whether a sample is kept only depends on the samples before it, so
+        compacting a longer series gives the same prefix: this doesn't
+        break incremental uploads.
+        """
+
+        timestamps = []
+        values = []
+        for timestamp, value in zip(self.timestamps, self.values):
+            if (
+                values
+                and value == values[-1]
+                and timestamp - timestamps[-1] < max_interval
+            ):
+                continue
+            timestamps.append(timestamp)
+            values.append(value)
+        return Series(timestamps, values, self.unit)
 
 
 def running_totals(deltas_by_timestamp):
-    """Turn `timestamp => key => delta` to `timestamp => key => total` by
-    summing deltas in order.
+    """Turn `timestamp => key => delta` to `key => Series` by summing deltas
+    in order.
+
+    Once a key has been seen, its total is reported at every later
+    timestamp.
     """
 
     current = {}
@@ -92,29 +307,78 @@ def running_totals(deltas_by_timestamp):
     for timestamp in sorted(deltas_by_timestamp.keys()):
         for k, delta in deltas_by_timestamp[timestamp].items():
             current[k] = current.get(k, 0) + delta
-        out[timestamp] = {k: v for k, v in current.items()}
+        for k, total in current.items():
+            series = out.get(k)
+            if series is None:
+                series = Series([], [])
+                out[k] = series
+            series.timestamps.append(timestamp)
+            series.values.append(total)
     return out
 
 
 def pivot(samples_by_timestamp):
-    """Turn `timestamp => key => value` to `key => [timestamp, value]`"""
+    """Turn `timestamp => key => value` to `key => Series`.  Timestamps must
+    be in ascending order.
+    """
 
     pivoted = {}
     for timestamp, kvs in samples_by_timestamp.items():
         for k, v in kvs.items():
-            samples = pivoted.get(k, [])
-            samples.append([timestamp, v])
-            pivoted[k] = samples
+            series = pivoted.get(k)
+            if series is None:
+                series = Series([], [])
+                pivoted[k] = series
+            series.timestamps.append(timestamp)
+            series.values.append(v)
     return pivoted
 
 
-def convert_samples(samples):
-    """Turn `[timestamp, float or int or decimal]` to `[timestamp, float or int]`"""
+class CreditsDebits:
+    """The total credit and debit of every account / currency on every
+    date, stored column-wise.
+
+    `dates` is the sorted list of day numbers and `keys` the list of
+    series keys.  Amounts are kept in one contiguous column per key: the
+    amount for key `k` on date `d` is at index `k * len(dates) + d` of the
+    `credit` and `debit` arrays.  They are fixed-point, in units of
+    `1 / units[k]`, with the scale being the commodity's precision.
+    """
+
+    def __init__(self, dates, keys, units, credit, debit):
+        self.dates = dates
+        self.keys = keys
+        self.units = units
+        self.credit = credit
+        self.debit = debit
+
+    def column(self, field, k):
+        """The `"credit"` or `"debit"` amounts of key `k`, by date."""
+
+        n = len(self.dates)
+        return getattr(self, field)[k * n : (k + 1) * n]
+
+    def deltas(self, k):
+        """The net change (debit - credit) of key `k`, by date."""
 
-    return [
-        [timestamp, value if isinstance(value, int) else float(value)]
-        for timestamp, value in samples
-    ]
+        return [
+            debit - credit
+            for credit, debit in zip(self.column("credit", k), self.column("debit", k))
+        ]
+
+    def matrix(self, field):
+        """The `"credit"` or `"debit"` amounts as a (key, date) NumPy array,
+        sharing memory with the column.
+        """
+
+        return numpy.frombuffer(getattr(self, field), dtype=numpy.int64).reshape(
+            len(self.keys), len(self.dates)
+        )
+
+    def timestamps(self):
+        """The dates as timestamps."""
+
+        return [day_to_timestamp(day) for day in self.dates]
 
 
 def preprocess_group_credits_debits(postings, only_leaves=False):
@@ -123,104 +387,231 @@ def preprocess_group_credits_debits(postings, only_leaves=False):
 
     Accounts are projected forwards and backwards in time.
 
-    Postings are applied to an account and all of its superaccounts, unless
-    `only_leaves` is set.
+    Postings are totalled per account and date, and then applied to the
+    account and all of its superaccounts, unless `only_leaves` is set.
     """
 
     key = lambda account, currency: (("account", account), ("currency", currency))
-    all_keys = set()
 
-    # credits_debits_by_date :: date => key => {credit, debit}
-    credits_debits_by_date = {}
+    # date_index :: date => index in order seen
+    # key_index :: key => index
+    # leaf_index :: (account, currency) => index in order seen
+    date_index = {}
+    key_index = {}
+    leaf_index = {}
+
+    # scales :: currency => decimal places
+    # leaf_currencies :: [currency], by leaf index
+    # leaf_keys :: [[key index]], by leaf index: the account and its
+    #   superaccounts, worked out once per account
+    scales = {}
+    leaf_currencies = []
+    leaf_keys = []
+
+    # leaf_cells :: (date index, leaf index) => [credit, debit]
+    leaf_cells = {}
     for posting in postings:
+        account = posting["account"]
         currency = posting["commodity"]
-        credit = Decimal(posting["credit"] or "0")
-        debit = Decimal(posting["debit"] or "0")
+        credit, credit_places = parse_amount(posting["credit"] or "0")
+        debit, debit_places = parse_amount(posting["debit"] or "0")
 
         if currency == "£":
             currency = "GBP"
 
-        credits_debits = credits_debits_by_date.get(posting["date"], {})
-        account = None
-        segments = (
-            [posting["account"]] if only_leaves else posting["account"].split(":")
-        )
-        for segment in segments:
-            if account is None:
-                account = segment
+        # hledger shows amounts with the commodity's display precision, so
+        # this should only increase the first time a commodity is seen
+        places = max(credit_places, debit_places)
+        scale = scales.get(currency, places)
+        if places > scale:
+            factor = 10 ** (places - scale)
+            for (_, leaf), cell in leaf_cells.items():
+                if leaf_currencies[leaf] == currency:
+                    cell[0] *= factor
+                    cell[1] *= factor
+            scale = places
+        scales[currency] = scale
+        credit *= 10 ** (scale - credit_places)
+        debit *= 10 ** (scale - debit_places)
+
+        d = date_index.setdefault(posting["date"], len(date_index))
+        leaf = leaf_index.get((account, currency))
+        if leaf is None:
+            leaf = leaf_index[(account, currency)] = len(leaf_index)
+            leaf_currencies.append(currency)
+            if only_leaves:
+                accounts = [account]
             else:
-                account = f"{account}:{segment}"
+                segments = account.split(":")
+                accounts = [":".join(segments[:i]) for i in range(1, len(segments) + 1)]
+            leaf_keys.append(
+                [
+                    key_index.setdefault(key(a, currency), len(key_index))
+                    for a in accounts
+                ]
+            )
 
-            k = key(account, currency)
-            all_keys.add(k)
+        cell = leaf_cells.get((d, leaf))
+        if cell is None:
+            leaf_cells[(d, leaf)] = [credit, debit]
+        else:
+            cell[0] += credit
+            cell[1] += debit
+
+    dates = sorted(date_index.keys())
+    sorted_position = [0] * len(dates)
+    for position, date in enumerate(dates):
+        sorted_position[date_index[date]] = position
+
+    # key_currencies :: [currency], by key index
+    key_currencies = [currency for (_, (_, currency)) in key_index.keys()]
+
+    # Roll the leaves up into their superaccounts, and project accounts
+    # through all time
+    credit_column = array.array("q", [0]) * (len(dates) * len(key_index))
+    debit_column = array.array("q", [0]) * (len(dates) * len(key_index))
+    for (d, leaf), (credit, debit) in leaf_cells.items():
+        position = sorted_position[d]
+        for k in leaf_keys[leaf]:
+            i = k * len(dates) + position
+            credit_column[i] += credit
+            debit_column[i] += debit
+
+    return CreditsDebits(
+        dates,
+        list(key_index.keys()),
+        [10 ** scales[currency] for currency in key_currencies],
+        credit_column,
+        debit_column,
+    )
 
-            old = credits_debits.get(k, {"credit": 0, "debit": 0})
-            credits_debits[k] = {
-                "credit": old["credit"] + credit,
-                "debit": old["debit"] + debit,
-            }
-        credits_debits_by_date[posting["date"]] = credits_debits
 
-    # Project accounts through all time
-    for timestamp in credits_debits_by_date.keys():
-        credits_debits = credits_debits_by_date[timestamp]
-        for k in all_keys:
-            credits_debits[k] = credits_debits.get(k, {"credit": 0, "debit": 0})
-        credits_debits_by_date[timestamp] = credits_debits
+def fx_rate(gbp_prices, currency, target_currency):
+    """Work out the exchange rate between two currencies from the GBP price
+    of each, or return `None` if either has no price.
 
-    return credits_debits_by_date
+    Prices are fixed-point `(value, places)` pairs, so the rate is worked out
+    exactly from those and rounded to a float once.
+    """
 
+    if currency == target_currency:
+        return 1
 
-def preprocess_prices(gbp_prices, credits_debits):
-    """Determines FX rates between all currency pairs.
+    if currency == "GBP":
+        from_fx, from_places = (1, 0)
+    elif currency in gbp_prices:
+        from_fx, from_places = gbp_prices[currency]
+    else:
+        return None
 
-    - Every currency has an exchange rate of 1 with itself.
+    if target_currency == "GBP":
+        to_fx, to_places = (1, 0)
+    elif target_currency in gbp_prices:
+        to_fx, to_places = gbp_prices[target_currency]
+    else:
+        return None
 
-    - Every currency has an exchange rate from GBP to itself at
-    1/rate.
+    return (from_fx * 10**to_places) / (to_fx * 10**from_places)
+
+
+def all_fx_pairs(gbp_prices):
+    """Every pair of currencies which has an exchange rate, given the GBP
+    price of each currency.
+    """
+
+    pairs = [("GBP", "GBP")]
+    for currency in gbp_prices.keys():
+        pairs.extend([(currency, currency), (currency, "GBP"), ("GBP", currency)])
+    for currency in gbp_prices.keys():
+        for target_currency in gbp_prices.keys():
+            if currency != target_currency:
+                pairs.append((currency, target_currency))
+    return pairs
+
+
+class FxRates:
+    """Exchange rates between currencies, stored only at the timestamps where
+    they change.
+
+    `change_timestamps` are the sorted timestamps of `P` directives and
+    `gbp_prices[i]` is the `currency => (value, places)` GBP prices given at
+    `change_timestamps[i]`.  The prices in effect at any timestamp are those
+    of the latest change at or before it.  Rates between other currency
+    pairs are only derived (via GBP) when they're needed.
+
+    `timestamps` is every timestamp a rate should be reported at.
+    """
+
+    def __init__(self, timestamps, change_timestamps, gbp_prices):
+        self.timestamps = timestamps
+        self.change_timestamps = change_timestamps
+        self.gbp_prices = gbp_prices
+
+    def prices_as_of(self, timestamp):
+        """The GBP prices in effect at a timestamp."""
+
+        i = bisect.bisect_right(self.change_timestamps, timestamp) - 1
+        return self.gbp_prices[i] if i >= 0 else {}
+
+    def samples(self, pairs=all_fx_pairs, dense=True):
+        """Yield `(timestamp, key => exchange_rate)` for every pair given by
+        `pairs(gbp_prices)`.
+
+        If `dense` is true there is a sample at every timestamp, otherwise
+        only at the first timestamp and when the rates change.  Rates are
+        derived once per change, and samples at timestamps in between
+        share the same dict.
+        """
+
+        key = lambda currency, target_currency: (
+            ("currency", currency),
+            ("target_currency", target_currency),
+        )
+
+        if dense:
+            timestamps = self.timestamps
+        else:
+            timestamps = sorted(set(self.timestamps[:1] + self.change_timestamps))
+
+        current_prices = None
+        rates = {}
+        for timestamp in timestamps:
+            gbp_prices = self.prices_as_of(timestamp)
+            if gbp_prices is not current_prices:
+                current_prices = gbp_prices
+                rates = {}
+                for currency, target_currency in pairs(gbp_prices):
+                    rate = fx_rate(gbp_prices, currency, target_currency)
+                    if rate is not None:
+                        rates[key(currency, target_currency)] = rate
+            yield (timestamp, rates)
 
-    - Every pair of currencies have exchange rates converting both
-    ways (via GBP).
+
+def preprocess_prices(gbp_prices, credits_debits):
+    """Parse GBP prices into an `FxRates` table.
 
     Exchange rates are projected forwards if there are credits /
     debits in a gap.
     """
 
-    key = lambda currency, target_currency: (
-        ("currency", currency),
-        ("target_currency", target_currency),
-    )
-
-    all_timestamps = {date_to_timestamp(date): True for date in credits_debits.keys()}
+    all_timestamps = set(credits_debits.timestamps())
 
     # gbp_fx_rates_by_timestamp :: timestamp => currency => gbp_exchange_rate
     gbp_fx_rates_by_timestamp = {}
-    for price in gbp_prices:
-        _, date, from_currency, gbp_exchange_rate = price.split()
-        timestamp = date_to_timestamp(date)
-        all_timestamps[timestamp] = True
-        gbp_exchange_rate = Decimal(gbp_exchange_rate[1:].replace(",", ""))
+    for day, from_currency, gbp_exchange_rate in gbp_prices:
+        timestamp = day_to_timestamp(day)
+        all_timestamps.add(timestamp)
 
         new_rates = gbp_fx_rates_by_timestamp.get(timestamp, {})
         new_rates[from_currency] = gbp_exchange_rate
         gbp_fx_rates_by_timestamp[timestamp] = new_rates
 
-    # fx_rates_by_timestamp :: timestamp => key => exchange_rate
-    fx_rates_by_timestamp = {}
-    gbp_fx_rates = {}
-    for timestamp in sorted(all_timestamps.keys()):
-        gbp_fx_rates = gbp_fx_rates_by_timestamp.get(timestamp, gbp_fx_rates)
-        fx_rates = {key("GBP", "GBP"): 1}
-        for currency, fx in gbp_fx_rates.items():
-            fx_rates[key(currency, currency)] = 1
-            fx_rates[key(currency, "GBP")] = fx
-            fx_rates[key("GBP", currency)] = 1 / fx
-        for currency, from_fx in gbp_fx_rates.items():
-            for target_currency, to_fx in gbp_fx_rates.items():
-                fx_rates[key(currency, target_currency)] = from_fx / to_fx
-        fx_rates_by_timestamp[timestamp] = fx_rates
-
-    return fx_rates_by_timestamp
+    change_timestamps = sorted(gbp_fx_rates_by_timestamp.keys())
+    return FxRates(
+        sorted(all_timestamps),
+        change_timestamps,
+        [gbp_fx_rates_by_timestamp[timestamp] for timestamp in change_timestamps],
+    )
 
 
 def metric_hledger_fx_rate(fx_rates):
@@ -235,27 +626,38 @@ def metric_hledger_fx_rate(fx_rates):
     ways (via GBP).
 
     Exchange rates are projected forwards if there are credits /
-    debits in a gap.
+    debits in a gap, unless only change points are being reported.
     """
 
-    return pivot(fx_rates)
+    return pivot(dict(fx_rates.samples(dense=DENSE_FX_RATES)))
+
 
+def metric_hledger_synthetic_balance_target(fx_rates):
+    """`hledger_synthetic_balance_target{account="xxx", currency="xxx"}`
 
-def metric_hledger_synthetic_balance_target(raw_targets):
-    """`hledger_synthetic_balance_target{account="xxx", currency="xxx"}`"""
+    These are the exchange rates from synthetic commodities to real ones.
+    """
 
     key = lambda account, currency: (
         ("account", account),
         ("currency", currency),
     )
 
-    # throw out unnecessary FX rates & rename keys
+    def pairs(gbp_prices):
+        targets = ["GBP"] + [c for c in gbp_prices.keys() if "syn:" not in c]
+        return [
+            (account, currency)
+            for account in gbp_prices.keys()
+            if "syn:" in account
+            for currency in targets
+        ]
+
+    # rename keys
     targets = {}
-    for timestamp, rates in raw_targets.items():
+    for timestamp, rates in fx_rates.samples(pairs=pairs, dense=DENSE_FX_RATES):
         targets[timestamp] = {
             key(account, currency): value
             for ((_, account), (_, currency)), value in rates.items()
-            if "syn:" in account and "syn:" not in currency
         }
 
     return pivot(targets)
@@ -269,107 +671,191 @@ def metric_hledger_balance(credits_debits):
     etc.
     """
 
-    # deltas_by_timestamp :: timestamp => key => delta
-    deltas_by_timestamp = {}
-    for date, kcds in credits_debits.items():
-        timestamp = date_to_timestamp(date)
-        deltas_by_timestamp[timestamp] = {
-            key: cd["debit"] - cd["credit"] for key, cd in kcds.items()
-        }
+    timestamps = credits_debits.timestamps()
 
-    return pivot(running_totals(deltas_by_timestamp))
+    # rows :: [balance], by key
+    if numpy is not None:
+        deltas = credits_debits.matrix("debit") - credits_debits.matrix("credit")
+        rows = numpy.cumsum(deltas, axis=1).tolist()
+    else:
+        rows = (
+            list(itertools.accumulate(credits_debits.deltas(k)))
+            for k in range(len(credits_debits.keys))
+        )
 
+    return {
+        key: Series(timestamps, row, unit)
+        for key, row, unit in zip(credits_debits.keys, rows, credits_debits.units)
+    }
 
-def metric_hledger_monthly_credits_debits(credits_debits, field):
-    """`hledger_monthly_xxx{account="xxx", currency="xxx"}`
 
-    Like `hledger_balance` but only sums the credits or debits (these
-    are two separate metrics).  These are also grouped by calendar
-    month, with all the transactions taking effect at midnight (UTC)
-    on the 1st.
+class FifoBuckets:
+    """A FIFO queue of deposits, for working out the age of money.
 
-    This drops the last calendar month, so only complete months are
-    present.
+    Each bucket records the running total of all deposits up to and
+    including it, and withdrawals just advance a cursor through those
+    totals, so buckets never need to be rewritten: a bucket is empty
+    once the total withdrawn reaches its running total.  Every deposit
+    and withdrawal is amortised O(1).
     """
 
-    # deltas_by_timestamp :: timestamp => key => delta
-    deltas_by_timestamp = {}
-    for date, kcds in credits_debits.items():
-        parsed = datetime.datetime.strptime(date, "%Y-%m-%d")
-        timestamp = calendar.timegm(parsed.replace(day=1).timetuple()) * 1000
-
-        deltas = deltas_by_timestamp.get(timestamp, {})
-        for key, cd in kcds.items():
-            deltas[key] = deltas.get(key, 0) + cd[field]
-        deltas_by_timestamp[timestamp] = deltas
-
-    del deltas_by_timestamp[max(deltas_by_timestamp.keys())]
-
-    return pivot(deltas_by_timestamp)
-
+    def __init__(self):
+        # buckets :: deque((timestamp, running total of deposits))
+        self.buckets = collections.deque()
+        self.deposited = 0
+        self.withdrawn = 0
+
+    def deposit(self, timestamp, amount):
+        if not self.buckets:
+            # anything withdrawn beyond what was deposited is forgotten
+            self.deposited = self.withdrawn
+        self.deposited += amount
+        self.buckets.append((timestamp, self.deposited))
+
+    def withdraw(self, amount):
+        self.withdrawn += amount
+        while self.buckets and self.buckets[0][1] <= self.withdrawn:
+            self.buckets.popleft()
+
+    def age(self, timestamp):
+        """Age in days of the oldest nonempty bucket, or 0 if there are none."""
+
+        if not self.buckets:
+            return 0
+        first_timestamp, _ = self.buckets[0]
+        return int((timestamp - first_timestamp) / 86400000)
+
+
+def month_runs(dates):
+    """Group sorted day numbers by calendar month.  Returns `(months,
+    month_index)`, the timestamp of the 1st of each month and the index
+    into that of each date.
+    """
 
-def metric_hledger_age_of_money(credits_debits):
-    """`hledger_age_of_money{account="xxx", currency="xxx"}`
+    months = []
+    month_index = []
+    for day in dates:
+        _, _, day_of_month = day_to_civil(day)
+        timestamp = day_to_timestamp(day - day_of_month + 1)
+        if not months or months[-1] != timestamp:
+            months.append(timestamp)
+        month_index.append(len(months) - 1)
+    return (months, month_index)
+
+
+def metric_hledger_accounts(credits_debits):
+    """`hledger_balance`, `hledger_monthly_increase`,
+    `hledger_monthly_decrease`, and `hledger_age_of_money`, all with
+    labels `{account="xxx", currency="xxx"}`.
+
+    These are computed together, in one pass over the dates of each
+    account, sharing the timestamps, month boundaries, and net changes.
+    Returns `name => key => Series`.
+
+    `hledger_transactions_total` and `quantified_self_age` are left out:
+    they have a few series for the whole journal rather than some for each
+    account, so they gain nothing from this loop, and as separate families
+    they can be computed alongside it with `METRIC_PROCESSES`.
+
+    `hledger_balance`: see `metric_hledger_balance`.
+
+    `hledger_monthly_xxx`: like `hledger_balance` but only sums the
+    debits (increase) or credits (decrease), grouped by calendar month,
+    with all the transactions taking effect at midnight (UTC) on the 1st.
+    The last calendar month is dropped, so only complete months are
+    present.
 
-    Gives the age (in days) of the oldest unit of money in that
-    account.  Age is calculated by taking the net change of every day,
-    if it's positive putting it in a new bucket, and if it's negative
+    `hledger_age_of_money`: the age (in days) of the oldest unit of money
+    in the account.  Age is calculated by taking the net change of every
+    day, if it's positive putting it in a new bucket, and if it's negative
     taking it from the oldest bucket.  The age is then the age of the
     oldest nonempty bucket.
     """
 
-    # deltas_by_timestamp :: timestamp => key => delta
-    deltas_by_timestamp = {}
-    for date, kcds in credits_debits.items():
-        timestamp = date_to_timestamp(date)
-        deltas_by_timestamp[timestamp] = {
-            key: cd["debit"] - cd["credit"] for key, cd in kcds.items()
-        }
-
-    # ages_by_timestamp :: timestamp => key => days
-    ages_by_timestamp = {}
-    buckets_by_key = {}
-    ages = {}
-    for timestamp in sorted(deltas_by_timestamp.keys()):
-        for key, delta in deltas_by_timestamp[timestamp].items():
-            ages[key] = ages.get(key, 0)
-            buckets = buckets_by_key.get(key, [])
-            if delta > 0:
-                if len(buckets) == 0:
-                    buckets = [(timestamp, delta)]
-                else:
-                    _, latest_value = buckets[-1]
-                    buckets.append((timestamp, latest_value + delta))
-            elif delta < 0:
-                buckets = [
-                    (timestamp, value + delta)
-                    for timestamp, value in buckets
-                    if value > -delta
-                ]
-            buckets_by_key[key] = buckets
-        for key in list(ages.keys()):
-            buckets = buckets_by_key[key]
-            if len(buckets) == 0:
-                ages[key] = 0
-            else:
-                first_timestamp, _ = buckets[0]
-                ages[key] = int((timestamp - first_timestamp) / 86400000)
-        ages_by_timestamp[timestamp] = {k: v for k, v in ages.items()}
+    timestamps = credits_debits.timestamps()
+    months, month_index = month_runs(credits_debits.dates)
+    complete_months = months[:-1]
+
+    # with NumPy the balances and monthly sums are done for every account at
+    # once, leaving only the age of money for the loop
+    if numpy is not None:
+        deltas = credits_debits.matrix("debit") - credits_debits.matrix("credit")
+        starts = [
+            i for i, m in enumerate(month_index) if i == 0 or m != month_index[i - 1]
+        ]
+        all_balances = numpy.cumsum(deltas, axis=1).tolist()
+        all_increases = numpy.add.reduceat(
+            credits_debits.matrix("debit"), starts, axis=1
+        )[:, :-1].tolist()
+        all_decreases = numpy.add.reduceat(
+            credits_debits.matrix("credit"), starts, axis=1
+        )[:, :-1].tolist()
+        all_deltas = deltas.tolist()
+
+    out = {
+        "hledger_balance": {},
+        "hledger_monthly_increase": {},
+        "hledger_monthly_decrease": {},
+        "hledger_age_of_money": {},
+    }
+    for k, key in enumerate(credits_debits.keys):
+        unit = credits_debits.units[k]
+        buckets = FifoBuckets()
+        ages = []
+
+        if numpy is not None:
+            for timestamp, delta in zip(timestamps, all_deltas[k]):
+                if delta > 0:
+                    buckets.deposit(timestamp, delta)
+                elif delta < 0:
+                    buckets.withdraw(-delta)
+                ages.append(buckets.age(timestamp))
+            balances = all_balances[k]
+            increases = all_increases[k]
+            decreases = all_decreases[k]
+        else:
+            balance = 0
+            balances = []
+            increases = [0] * len(months)
+            decreases = [0] * len(months)
+            for timestamp, m, credit, debit in zip(
+                timestamps,
+                month_index,
+                credits_debits.column("credit", k),
+                credits_debits.column("debit", k),
+            ):
+                delta = debit - credit
+                balance += delta
+                balances.append(balance)
+                increases[m] += debit
+                decreases[m] += credit
+                if delta > 0:
+                    buckets.deposit(timestamp, delta)
+                elif delta < 0:
+                    buckets.withdraw(-delta)
+                ages.append(buckets.age(timestamp))
+            del increases[len(complete_months) :]
+            del decreases[len(complete_months) :]
+
+        out["hledger_balance"][key] = Series(timestamps, balances, unit)
+        out["hledger_monthly_increase"][key] = Series(complete_months, increases, unit)
+        out["hledger_monthly_decrease"][key] = Series(complete_months, decreases, unit)
+        out["hledger_age_of_money"][key] = Series(timestamps, ages)
 
-    return pivot(ages_by_timestamp)
+    return out
 
 
-def metric_hledger_transactions_total(postings):
-    """`hledger_transactions_total{status="(pending|bookkeeping|cleared)"}`"""
+def group_transactions(postings, txnids_by_timestamp):
+    """Pass a stream of postings through, recording the ID of each one's
+    transaction in `txnids_by_timestamp :: timestamp => key => set(txn_id)`.
+    """
 
     TRANSACTION_STATUS_NAMES = {"": "pending", "!": "bookkeeping", "*": "cleared"}
 
     key = lambda status: (("status", TRANSACTION_STATUS_NAMES[status]),)
 
-    # txnids_by_timestamp :: timestamp => key => set(txn_id)
-    txnids_by_timestamp = {}
     for posting in postings:
-        timestamp = date_to_timestamp(posting["date"])
+        timestamp = day_to_timestamp(posting["date"])
         status = posting["status"]
 
         txnids_by_status = txnids_by_timestamp.get(timestamp, {})
@@ -378,107 +864,1023 @@ def metric_hledger_transactions_total(postings):
         txnids_by_status[key(status)] = txnids
         txnids_by_timestamp[timestamp] = txnids_by_status
 
-    # counts_by_timestamp :: timestamp => key => int
-    counts_by_timestamp = {
-        ts: {k: len(ids) for k, ids in vs.items()}
-        for ts, vs in txnids_by_timestamp.items()
-    }
+        yield posting
 
-    return pivot(running_totals(counts_by_timestamp))
+
+def metric_hledger_transactions_total(counts_by_timestamp):
+    """`hledger_transactions_total{status="(pending|bookkeeping|cleared)"}`
+
+    Takes `timestamp => key => number of transactions`.
+    """
+
+    return running_totals(counts_by_timestamp)
 
 
 def metric_quantified_self_age(credits_debits):
     """`quantified_self_age{unit="{days|years}"}`"""
 
-    # ages_by_timestamp :: timestamp => key => int
-    ages_by_timestamp = {}
-    for datestr in sorted(credits_debits.keys()):
-        date = datetime.datetime.strptime(datestr, "%Y-%m-%d")
-        timestamp = calendar.timegm(date.timetuple()) * 1000
+    timestamps = credits_debits.timestamps()
+    days = Series(timestamps, [])
+    years = Series(timestamps, [])
+
+    dob_day = civil_to_day(*DOB)
+    dob_year, dob_month, dob_day_of_month = DOB
+    for day in credits_debits.dates:
+        year, month, day_of_month = day_to_civil(day)
+        if (month, day_of_month) < (dob_month, dob_day_of_month):
+            year -= 1
+        days.values.append(day - dob_day)
+        years.values.append(year - dob_year)
+
+    return {(("unit", "days"),): days, (("unit", "years"),): years}
+
 
-        days = (date - DOB).days
-        years = date.year - DOB.year
-        if (date.month, date.day) < (DOB.month, DOB.day):
-            years -= 1
+def load_journals(main=True, synthetic=True):
+    """Run hledger over the journal and / or the synthetic balances journal,
+    and preprocess the output.
 
-        ages_by_timestamp[timestamp] = {
-            (("unit", "days"),): days,
-            (("unit", "years"),): years,
+    All the hledger commands are run at once, each feeding its own pipeline.
+    """
+
+    txnids_by_timestamp = {}
+    futures = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+        if main:
+            futures["prices"] = pool.submit(
+                lambda: read_prices(hledger_command(["prices"]))
+            )
+            futures["credits_debits"] = pool.submit(
+                lambda: preprocess_group_credits_debits(
+                    group_transactions(
+                        read_postings(hledger_command(["print", "-O", "csv"])),
+                        txnids_by_timestamp,
+                    )
+                )
+            )
+        if synthetic:
+            futures["synthetic_prices"] = pool.submit(
+                lambda: read_prices(
+                    line for line in synthetic_command(["prices"]) if "syn:" in line
+                )
+            )
+            futures["synthetic_credits_debits"] = pool.submit(
+                lambda: preprocess_group_credits_debits(
+                    (
+                        row
+                        for row in read_postings(
+                            synthetic_command(["print", "-O", "csv"])
+                        )
+                        if row["account"] != "syn:ignore"
+                    ),
+                    only_leaves=True,
+                )
+            )
+
+    journals = {name: future.result() for name, future in futures.items()}
+    if main:
+        journals["transaction_counts"] = {
+            ts: {k: len(ids) for k, ids in vs.items()}
+            for ts, vs in txnids_by_timestamp.items()
         }
+    return journals
+
+
+def journal_files(path):
+    """Return `path` and every file it includes, recursively."""
+
+    files = []
+
+    def visit(path):
+        if path in files:
+            return
+        files.append(path)
+
+        try:
+            with open(path, encoding="utf-8") as f:
+                lines = f.readlines()
+        except OSError:
+            return
+
+        dirname = os.path.dirname(path)
+        for line in lines:
+            match = re.match(r"include\s+(.*)", line)
+            if match is None:
+                continue
+            pattern = match.group(1).strip()
+            # strip an explicit reader prefix, like `timedot:`
+            prefix, _, rest = pattern.partition(":")
+            if prefix in HLEDGER_READERS:
+                pattern = rest
+            pattern = os.path.join(dirname, os.path.expanduser(pattern))
+            for included in sorted(glob.glob(pattern, recursive=True)) or [pattern]:
+                visit(included)
+
+    visit(path)
+    return files
+
+
+def journal_cache_key():
+    """A key which changes whenever anything hledger reads, or how its
+    output is processed, changes.
+    """
 
-    return pivot(ages_by_timestamp)
-
-
-raw_prices = [
-    offset_price_date(line, YEAR_OFFSET)
-    for line in hledger_command(["prices"]).splitlines()
-]
-raw_postings = [
-    offset_posting_date(row, YEAR_OFFSET)
-    for row in csv.DictReader(io.StringIO(hledger_command(["print", "-O", "csv"])))
-]
-credits_debits = preprocess_group_credits_debits(raw_postings)
-
-synthetic_prices = [
-    offset_price_date(line, YEAR_OFFSET)
-    for line in synthetic_command(["prices"]).splitlines()
-    if "syn:" in line
-]
-synthetic_postings = [
-    offset_posting_date(row, YEAR_OFFSET)
-    for row in csv.DictReader(io.StringIO(synthetic_command(["print", "-O", "csv"])))
-    if row["account"] != "syn:ignore"
-]
-synthetic_credits_debits = preprocess_group_credits_debits(
-    synthetic_postings, only_leaves=True
-)
-
-metrics = {
-    "hledger_fx_rate": metric_hledger_fx_rate(
-        preprocess_prices(raw_prices, credits_debits)
-    ),
-    "hledger_balance": metric_hledger_balance(credits_debits),
-    "hledger_monthly_increase": metric_hledger_monthly_credits_debits(
-        credits_debits, "debit"
-    ),
-    "hledger_monthly_decrease": metric_hledger_monthly_credits_debits(
-        credits_debits, "credit"
-    ),
-    "hledger_age_of_money": metric_hledger_age_of_money(credits_debits),
-    "hledger_transactions_total": metric_hledger_transactions_total(raw_postings),
-    "hledger_synthetic_balance": metric_hledger_balance(synthetic_credits_debits),
-    "hledger_synthetic_balance_target": metric_hledger_synthetic_balance_target(
-        preprocess_prices(synthetic_prices, synthetic_credits_debits)
-    ),
-    "quantified_self_age": metric_quantified_self_age(credits_debits),
-}
+    files = journal_files(os.getenv("LEDGER_FILE")) + journal_files(
+        synthetic_journal_file()
+    )
+
+    digest = hashlib.sha256()
+    digest.update(f"{CACHE_VERSION} {YEAR_OFFSET}\n".encode("utf-8"))
+    for path in files:
+        digest.update(f"{path}\n".encode("utf-8"))
+        try:
+            with open(path, "rb") as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+        except OSError:
+            digest.update(b"missing")
+    return digest.hexdigest()
+
+
+def load_journals_cached():
+    """Like `load_journals`, but if none of the journal files have changed
+    since the last run load the result from the cache instead.
+    """
+
+    if CACHE_FILE is None:
+        return load_journals()
+
+    key = journal_cache_key()
+
+    if not FULL_REBUILD:
+        try:
+            with gzip.open(CACHE_FILE, "rb") as f:
+                if pickle.load(f) == key:
+                    print("Journals unchanged, using cache")
+                    return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+
+    journals = load_journals()
 
-for name, values in metrics.items():
     if not DRY_RUN:
-        requests.post(
-            f"{VICTORIAMETRICS_URI}/api/v1/admin/tsdb/delete_series?match[]={name}"
-        ).raise_for_status()
+        tmp_file = f"{CACHE_FILE}.tmp"
+        with gzip.open(tmp_file, "wb", compresslevel=1) as f:
+            pickle.dump(key, f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(journals, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, CACHE_FILE)
 
-    for labels_tuples, samples in values.items():
-        print(f"Uploading {name} {labels_tuples} ({len(samples)} samples)")
+    return journals
 
+
+def series_selector(name, labels_tuples):
+    """Render a series as a selector like `name{label="value",...}`, which
+    is used both as its key in the state file and to delete it.
+    """
+
+    escape = lambda v: v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    labels = ",".join(f'{k}="{escape(v)}"' for k, v in labels_tuples)
+    return f"{name}{{{labels}}}"
+
+
+def plan_upload(timestamps, values, previous):
+    """Work out which samples of a series need to be uploaded, given its
+    state from the previous run (or `None` if it wasn't exported then).
+
+    If the samples up to the previously exported timestamp are unchanged
+    only the new tail needs to be sent.  Otherwise some older posting has
+    been edited, and the series must be deleted and sent in full.
+
+    Returns `(rebuild, first_sample_to_upload, new_state)`.
+    """
+
+    split = 0
+    if previous is not None and previous["last_timestamp"] is not None:
+        split = bisect.bisect_right(timestamps, previous["last_timestamp"])
+
+    digest = hashlib.sha256()
+    for timestamp, value in zip(timestamps[:split], values[:split]):
+        digest.update(f"{timestamp} {value!r}\n".encode("utf-8"))
+    prefix_digest = digest.hexdigest()
+    for timestamp, value in zip(timestamps[split:], values[split:]):
+        digest.update(f"{timestamp} {value!r}\n".encode("utf-8"))
+
+    new_state = {
+        "last_timestamp": timestamps[-1] if timestamps else None,
+        "count": len(timestamps),
+        "digest": digest.hexdigest(),
+    }
+
+    if previous is None:
+        return (False, 0, new_state)
+    if previous["count"] == split and previous["digest"] == prefix_digest:
+        return (False, split, new_state)
+    return (True, 0, new_state)
+
+
+def load_state():
+    """Load the state saved by the previous run, or return `None` if a full
+    rebuild is needed.
+    """
+
+    if STATE_FILE is None or FULL_REBUILD:
+        return None
+
+    try:
+        with open(STATE_FILE) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    if state.get("version") != STATE_VERSION:
+        return None
+    if state.get("year_offset") != YEAR_OFFSET:
+        return None
+    return state
+
+
+def invalidate_state():
+    """Remove the saved state before changing anything in VictoriaMetrics, so
+    that an interrupted run is followed by a full rebuild rather than by
+    re-sending samples which may already be there.
+    """
+
+    if STATE_FILE is None or DRY_RUN:
+        return
+
+    try:
+        os.remove(STATE_FILE)
+    except FileNotFoundError:
+        pass
+
+
+def save_state(state):
+    """Atomically write out the state for the next run."""
+
+    if STATE_FILE is None or DRY_RUN:
+        return
+
+    tmp_file = f"{STATE_FILE}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_file, STATE_FILE)
+
+
+async def victoriametrics_request(method, path, **kwargs):
+    """Make a request to VictoriaMetrics in a worker thread, retrying
+    connection errors, timeouts, and 429 / 5xx responses with exponential
+    backoff.  Throws an error if the last attempt fails.
+    """
+
+    for attempt in range(UPLOAD_RETRIES + 1):
+        try:
+            response = await asyncio.to_thread(
+                SESSION.request,
+                method,
+                f"{VICTORIAMETRICS_URI}{path}",
+                timeout=UPLOAD_TIMEOUT,
+                **kwargs,
+            )
+            response.raise_for_status()
+            return response
+        except requests.RequestException as e:
+            status = None if e.response is None else e.response.status_code
+            retryable = status is None or status == 429 or status >= 500
+            if attempt == UPLOAD_RETRIES or not retryable:
+                raise
+            delay = UPLOAD_RETRY_DELAY * 2**attempt * random.uniform(1, 1.5)
+            print(f"{method} {path} failed ({e}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def delete_series(selector):
+    """Delete every series matching the selector."""
+
+    print(f"Deleting {selector}")
+
+    if not DRY_RUN:
+        await victoriametrics_request(
+            "POST", "/api/v1/admin/tsdb/delete_series", params={"match[]": selector}
+        )
+
+
+# Samples encoded at once by the line-based encoders, which can split a
+# series across requests at these boundaries
+ENCODER_CHUNK_SAMPLES = 4096
+
+
+class JsonEncoder:
+    """Encodes a series as a line of JSON, for `/api/v1/import`."""
+
+    path = "/api/v1/import"
+
+    def params(self, name, labels_tuples):
+        return None
+
+    def encode(self, name, labels_tuples, timestamps, values):
         labels = dict(labels_tuples)
         labels["__name__"] = name
-        samples = convert_samples(samples)
-        json = {
+        payload = {
             "metric": labels,
-            "values": [v for _, v in samples],
-            "timestamps": [t for t, _ in samples],
+            "values": values,
+            "timestamps": timestamps,
+        }
+        yield json.dumps(payload, separators=(",", ":")) + "\n"
+
+
+class CsvEncoder:
+    """Encodes a series as `timestamp,value,label,...` lines, for
+    `/api/v1/import/csv`.
+
+    The metric name and label names go in the `format` parameter, so each
+    request can only hold series with the same name and labels.
+    """
+
+    path = "/api/v1/import/csv"
+
+    def params(self, name, labels_tuples):
+        columns = ["1:time:unix_ms", f"2:metric:{name}"]
+        columns.extend(
+            f"{i}:label:{k}" for i, (k, _) in enumerate(labels_tuples, start=3)
+        )
+        return {"format": ",".join(columns)}
+
+    def encode(self, name, labels_tuples, timestamps, values):
+        quote = lambda v: (
+            '"' + v.replace('"', '""') + '"' if any(c in v for c in ',"\n') else v
+        )
+        suffix = "".join(f",{quote(v)}" for _, v in labels_tuples) + "\n"
+
+        for i in range(0, len(timestamps), ENCODER_CHUNK_SAMPLES):
+            yield "".join(
+                f"{t},{v!r}{suffix}"
+                for t, v in zip(
+                    timestamps[i : i + ENCODER_CHUNK_SAMPLES],
+                    values[i : i + ENCODER_CHUNK_SAMPLES],
+                )
+            )
+
+
+class PrometheusEncoder:
+    """Encodes a series as `name{label="value",...} value timestamp` lines,
+    for `/api/v1/import/prometheus`.
+    """
+
+    path = "/api/v1/import/prometheus"
+
+    def params(self, name, labels_tuples):
+        return None
+
+    def encode(self, name, labels_tuples, timestamps, values):
+        prefix = series_selector(name, labels_tuples) if labels_tuples else name
+
+        for i in range(0, len(timestamps), ENCODER_CHUNK_SAMPLES):
+            yield "".join(
+                f"{prefix} {v!r} {t}\n"
+                for t, v in zip(
+                    timestamps[i : i + ENCODER_CHUNK_SAMPLES],
+                    values[i : i + ENCODER_CHUNK_SAMPLES],
+                )
+            )
+
+
+ENCODERS = {
+    "json": JsonEncoder,
+    "csv": CsvEncoder,
+    "prometheus": PrometheusEncoder,
+}
+
+
+class Uploader:
+    """Batches series up, and sends them to VictoriaMetrics as a single
+    gzip-compressed request in the `UPLOAD_FORMAT` wire format, unless another
+    `encoder` is given.
+
+    A batch is sent when it has `max_series` series or when adding another
+    chunk of encoded samples would take it over `max_bytes` (before
+    compression), and when `flush` is called.  Series are encoded straight
+    into the compressed request body.
+
+    Up to `concurrency` batches are sent at once, in the background: `close`
+    waits for them all to finish.  A batch which still fails after retrying
+    doesn't stop the upload, its series are recorded in `failed` instead.
+    """
+
+    def __init__(
+        self,
+        max_series=UPLOAD_BATCH_SERIES,
+        max_bytes=UPLOAD_BATCH_BYTES,
+        encoder=None,
+        concurrency=UPLOAD_CONCURRENCY,
+    ):
+        if encoder is None:
+            if UPLOAD_FORMAT not in ENCODERS:
+                raise ValueError(
+                    f"unknown UPLOAD_FORMAT {UPLOAD_FORMAT!r}, expected one of: "
+                    + ", ".join(ENCODERS)
+                )
+            encoder = ENCODERS[UPLOAD_FORMAT]()
+
+        self.max_series = max_series
+        self.max_bytes = max_bytes
+        self.encoder = encoder
+        self.params = None
+        self.slots = asyncio.Semaphore(concurrency)
+        self.in_flight = set()
+        # failed :: {(name, labels_tuples)}
+        self.failed = set()
+        self.sent_bytes = 0
+        self.sent_compressed_bytes = 0
+        self.requests = 0
+        self.reset()
+
+    def reset(self):
+        self.body = io.BytesIO()
+        # the encoded series are very repetitive, so even the fastest level
+        # does well
+        self.compressor = gzip.GzipFile(fileobj=self.body, mode="wb", compresslevel=1)
+        self.series = 0
+        self.bytes = 0
+        self.contents = set()
+
+    async def add(self, name, labels_tuples, timestamps, values):
+        """Queue up samples (with real, not fixed-point, values) for one series."""
+
+        print(f"Uploading {name} {labels_tuples} ({len(timestamps)} samples)")
+
+        params = self.encoder.params(name, labels_tuples)
+        if params != self.params:
+            await self.flush()
+            self.params = params
+
+        for chunk in self.encoder.encode(name, labels_tuples, timestamps, values):
+            if DRY_RUN:
+                print(chunk, end="")
+                continue
+
+            chunk = chunk.encode("utf-8")
+            if self.bytes > 0 and self.bytes + len(chunk) > self.max_bytes:
+                await self.flush()
+
+            self.compressor.write(chunk)
+            self.bytes += len(chunk)
+            self.contents.add((name, labels_tuples))
+
+        self.series += 1
+        if self.series >= self.max_series:
+            await self.flush()
+
+    async def flush(self):
+        """Start sending the current batch, if there is one, waiting for a
+        free slot first.
+        """
+
+        if self.bytes == 0:
+            return
+
+        self.compressor.close()
+        batch = (self.series, self.bytes, self.body.getvalue(), self.contents)
+        self.reset()
+
+        await self.slots.acquire()
+        task = asyncio.create_task(self.send(self.params, *batch))
+        self.in_flight.add(task)
+        task.add_done_callback(self.in_flight.discard)
+
+    async def send(self, params, series, size, body, contents):
+        try:
+            print(f"Sending {series} series ({size} bytes, {len(body)} gzipped)")
+            await victoriametrics_request(
+                "POST",
+                self.encoder.path,
+                params=params,
+                data=body,
+                headers={"Content-Encoding": "gzip"},
+            )
+            self.sent_bytes += size
+            self.sent_compressed_bytes += len(body)
+            self.requests += 1
+        except requests.RequestException as e:
+            print(f"Failed to send {series} series: {e}")
+            self.failed.update(contents)
+        finally:
+            self.slots.release()
+
+    async def close(self):
+        """Send the current batch, and wait for everything to be sent."""
+
+        await self.flush()
+        await asyncio.gather(*self.in_flight)
+
+
+class ExportStats:
+    """Timings and counts about the export itself, which are uploaded as
+    their own series (`hledger_export_*`) alongside the real metrics.
+
+    There is one sample per run, so these skip the saved state entirely.
+    """
+
+    def __init__(self):
+        # stats :: name => labels_tuples => value
+        self.stats = {}
+
+    def record(self, name, labels_tuples, value):
+        self.stats.setdefault(name, {})[labels_tuples] = value
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """Time a block as `hledger_export_stage_seconds{stage="xxx"}`."""
+
+        start = time.perf_counter()
+        yield
+        self.record(
+            "hledger_export_stage_seconds",
+            (("stage", stage),),
+            time.perf_counter() - start,
+        )
+
+    async def upload(self):
+        timestamp = int(time.time() * 1000)
+
+        uploader = Uploader()
+        for name, values in self.stats.items():
+            for labels_tuples, value in values.items():
+                await uploader.add(name, labels_tuples, [timestamp], [value])
+        await uploader.close()
+
+
+def metric_families(journals):
+    """Every metric, as `name => (function, *args)`, given the preprocessed
+    journals.
+
+    Families which are computed together are keyed by a tuple of names, and
+    their function returns `name => values`.
+    """
+
+    credits_debits = journals["credits_debits"]
+    synthetic_credits_debits = journals["synthetic_credits_debits"]
+
+    return {
+        "hledger_fx_rate": (
+            metric_hledger_fx_rate,
+            preprocess_prices(journals["prices"], credits_debits),
+        ),
+        (
+            "hledger_balance",
+            "hledger_monthly_increase",
+            "hledger_monthly_decrease",
+            "hledger_age_of_money",
+        ): (metric_hledger_accounts, credits_debits),
+        "hledger_transactions_total": (
+            metric_hledger_transactions_total,
+            journals["transaction_counts"],
+        ),
+        "hledger_synthetic_balance": (
+            metric_hledger_balance,
+            synthetic_credits_debits,
+        ),
+        "hledger_synthetic_balance_target": (
+            metric_hledger_synthetic_balance_target,
+            preprocess_prices(journals["synthetic_prices"], synthetic_credits_debits),
+        ),
+        "quantified_self_age": (metric_quantified_self_age, credits_debits),
+    }
+
+
+def compute_metric_family(families, names):
+    """Compute one entry of `metric_families`, returning `([(name, values)],
+    seconds taken)`.
+    """
+
+    function, *args = families[names]
+    start = time.perf_counter()
+    values = function(*args)
+    seconds = time.perf_counter() - start
+
+    if isinstance(names, tuple):
+        return ([(name, values[name]) for name in names], seconds)
+    return ([(names, values)], seconds)
+
+
+# The metric families, in a worker process
+WORKER_FAMILIES = None
+
+
+def init_worker(families):
+    global WORKER_FAMILIES
+    WORKER_FAMILIES = families
+
+
+def compute_worker_metric_family(names):
+    return compute_metric_family(WORKER_FAMILIES, names)
+
+
+async def compute_metrics(journals, stats, only=None):
+    """Compute every metric family, timing each one, and yield `(name,
+    values)` for each as soon as it's done.
+
+    With more than one `METRIC_PROCESSES`, the families are computed in
+    forked worker processes, which share the preprocessed journals with this
+    one rather than having them pickled.
+
+    Families which are computed together each get the time for the lot.
+
+    If `only` is given, just the families it names are computed.
+    """
+
+    families = metric_families(journals)
+    if only is not None:
+        families = {
+            names: family
+            for names, family in families.items()
+            if not set(names if isinstance(names, tuple) else [names]).isdisjoint(only)
         }
+    start = time.perf_counter()
+
+    def record(name, values, seconds):
+        labels_tuples = (("metric", name),)
+        stats.record("hledger_export_metric_seconds", labels_tuples, seconds)
+        stats.record("hledger_export_series_total", labels_tuples, len(values))
+        stats.record(
+            "hledger_export_samples_total",
+            labels_tuples,
+            sum(len(series) for series in values.values()),
+        )
+
+    if METRIC_PROCESSES > 1:
+        loop = asyncio.get_running_loop()
+
+        async def compute(names):
+            return await loop.run_in_executor(pool, compute_worker_metric_family, names)
+
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=METRIC_PROCESSES,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=init_worker,
+            initargs=(families,),
+        ) as pool:
+            for done in asyncio.as_completed([compute(names) for names in families]):
+                computed, seconds = await done
+                for name, values in computed:
+                    record(name, values, seconds)
+                    yield (name, values)
+    else:
+        for names in families:
+            computed, seconds = compute_metric_family(families, names)
+            for name, values in computed:
+                record(name, values, seconds)
+                yield (name, values)
+
+    stats.record(
+        "hledger_export_stage_seconds",
+        (("stage", "compute_metrics"),),
+        time.perf_counter() - start,
+    )
+
+
+async def export_metrics(metrics, stats):
+    """Upload a stream of `(name, values)` metrics to VictoriaMetrics, sending
+    only what has changed since the last run.
+
+    Families missing from the stream are left as they are.
+
+    Returns the number of series which failed to upload.  They are deleted
+    and sent in full next time.
+    """
 
-        if DRY_RUN:
-            print(json)
+    old_state = load_state()
+    new_state = {"version": STATE_VERSION, "year_offset": YEAR_OFFSET, "series": {}}
+
+    uploader = Uploader()
+
+    invalidate_state()
+
+    # keys_by_name :: name => [labels_tuples]
+    keys_by_name = {}
+    async for name, values in metrics:
+        keys_by_name[name] = list(values.keys())
+        if old_state is None:
+            await delete_series(name)
+
+        uploaded = 0
+
+        for labels_tuples, series in values.items():
+            if SAMPLE_HEARTBEAT_DAYS > 0:
+                series = series.compact(day_to_timestamp(SAMPLE_HEARTBEAT_DAYS))
+
+            selector = series_selector(name, labels_tuples)
+            previous = (
+                None if old_state is None else old_state["series"].pop(selector, None)
+            )
+            timestamps = series.timestamps
+            real_values = series.real_values()
+            rebuild, start, new_state["series"][selector] = plan_upload(
+                timestamps, real_values, previous
+            )
+
+            if rebuild:
+                await delete_series(selector)
+            if start < len(timestamps):
+                await uploader.add(
+                    name, labels_tuples, timestamps[start:], real_values[start:]
+                )
+                uploaded += len(timestamps) - start
+
+        stats.record(
+            "hledger_export_uploaded_samples_total", (("metric", name),), uploaded
+        )
+
+    # anything left over from the families exported no longer exists
+    if old_state is not None:
+        for selector, previous in old_state["series"].items():
+            name, _, _ = selector.partition("{")
+            if name in keys_by_name:
+                await delete_series(selector)
+            else:
+                new_state["series"][selector] = previous
+
+    await uploader.close()
+
+    for name, keys in keys_by_name.items():
+        failed = [k for k in keys if (name, k) in uploader.failed]
+        print(
+            f"{name}: uploaded {len(keys) - len(failed)} series, {len(failed)} failed"
+        )
+        stats.record(
+            "hledger_export_upload_failed_series_total",
+            (("metric", name),),
+            len(failed),
+        )
+        # an impossible state, so that the series is rebuilt next time
+        for labels_tuples in failed:
+            new_state["series"][series_selector(name, labels_tuples)] = {
+                "last_timestamp": None,
+                "count": None,
+                "digest": None,
+            }
+
+    stats.record("hledger_export_uploaded_bytes_total", (), uploader.sent_bytes)
+    stats.record(
+        "hledger_export_uploaded_compressed_bytes_total",
+        (),
+        uploader.sent_compressed_bytes,
+    )
+    stats.record("hledger_export_upload_requests_total", (), uploader.requests)
+
+    if not DRY_RUN:
+        await victoriametrics_request("GET", "/internal/resetRollupResultCache")
+
+    save_state(new_state)
+
+    return len(uploader.failed)
+
+
+async def write_snapshot(metrics, path):
+    """Atomically write a stream of `(name, values)` metrics to a snapshot
+    file.
+
+    Series are written in the order they are computed, which with
+    `METRIC_PROCESSES` isn't deterministic: sort the lines to compare two
+    snapshots.
+    """
+
+    encoder = JsonEncoder()
+
+    tmp_file = f"{path}.tmp"
+    with gzip.open(tmp_file, "wt", encoding="utf-8", compresslevel=6) as f:
+        async for name, values in metrics:
+            print(f"Writing {name} ({len(values)} series)")
+            for labels_tuples, series in values.items():
+                f.writelines(
+                    encoder.encode(
+                        name, labels_tuples, series.timestamps, series.real_values()
+                    )
+                )
+    os.replace(tmp_file, path)
+
+
+async def read_snapshot(path):
+    """Read a snapshot file back as a stream of `(name, values)` metrics."""
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        rows = (json.loads(line) for line in f)
+        for name, group in itertools.groupby(
+            rows, key=lambda row: row["metric"]["__name__"]
+        ):
+            values = {}
+            for row in group:
+                labels = row["metric"]
+                del labels["__name__"]
+                values[tuple(labels.items())] = Series(row["timestamps"], row["values"])
+            yield (name, values)
+
+
+class Inotify:
+    """Just enough of inotify(7), through ctypes, to watch directories for
+    files being written, created, moved, or deleted.
+    """
+
+    # event flags, from <sys/inotify.h>
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        # directories :: watch descriptor => directory
+        self.directories = {}
+
+    def watch(self, directory):
+        """Watch a directory, if it isn't already being watched."""
+
+        if directory in self.directories.values():
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), directory)
+        self.directories[wd] = directory
+
+    def read(self, timeout):
+        """Wait up to `timeout` seconds (or forever, if `None`) for events,
+        and return the set of paths they are about.
+        """
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+
+        buf = os.read(self.fd, 64 * 1024)
+        paths = set()
+        offset = 0
+        while offset < len(buf):
+            wd, _, _, length = struct.unpack_from("iIII", buf, offset)
+            offset += struct.calcsize("iIII")
+            name = buf[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if wd in self.directories:
+                paths.add(os.path.join(self.directories[wd], os.fsdecode(name)))
+        return paths
+
+    def wait(self, debounce, timeout=None):
+        """Block until there are events (for up to `timeout` seconds, if not
+        `None`), and then until there have been none for `debounce` seconds.
+        Return the set of paths they are about.
+        """
+
+        paths = self.read(timeout)
+        if not paths:
+            return paths
+        while True:
+            more = self.read(debounce)
+            if not more:
+                return paths
+            paths |= more
+
+
+def export(metrics, stats):
+    """Upload a stream of metrics, or write them to the snapshot file.
+    Returns the number of series which failed to upload.
+    """
+
+    if SNAPSHOT_FILE is not None:
+        asyncio.run(write_snapshot(metrics, SNAPSHOT_FILE))
+        return 0
+
+    # computing metrics overlaps with uploading them, so the time for both is
+    # recorded as "export", and compute_metrics records its own
+    with stats.stage("export"):
+        return asyncio.run(export_metrics(metrics, stats))
+
+
+def watch():
+    """Export everything, and then keep the preprocessed journals in memory
+    and export again whenever the journal files change.  Only the journal
+    which changed is re-run through hledger, and only the metrics which
+    depend on it are exported.
+
+    Errors (like a half-edited journal which hledger can't parse, or
+    VictoriaMetrics being down) are reported, and then everything is
+    exported again after the next change or once `WATCH_RETRY_DELAY` has
+    passed, whichever is first.
+    """
+
+    global FULL_REBUILD
+
+    inotify = Inotify()
+    journals = None
+    main_changed = synthetic_changed = True
+    retry_delay = None
+    while True:
+        main_files = journal_files(os.getenv("LEDGER_FILE"))
+        synthetic_files = journal_files(synthetic_journal_file())
+        # editors often replace files rather than writing to them, so watch
+        # the directories
+        for path in main_files + synthetic_files:
+            inotify.watch(os.path.dirname(os.path.abspath(path)))
+
+        stats = ExportStats()
+        try:
+            with stats.stage("total"):
+                with stats.stage("load_journals"):
+                    if journals is None:
+                        journals = load_journals_cached()
+                    else:
+                        journals.update(
+                            load_journals(
+                                main=main_changed, synthetic=synthetic_changed
+                            )
+                        )
+
+                # without a saved state every family has to be rebuilt, or
+                # the ones not exported now would be sent in full on top of
+                # their old samples next time.  After a failure the state
+                # doesn't say which families are affected.
+                only = None
+                if retry_delay is None and load_state() is not None:
+                    if not synthetic_changed:
+                        only = [
+                            name
+                            for names in metric_families(journals)
+                            for name in (names if isinstance(names, tuple) else [names])
+                            if name not in SYNTHETIC_FAMILIES
+                        ]
+                    elif not main_changed:
+                        only = SYNTHETIC_FAMILIES
+                failed = export(compute_metrics(journals, stats, only), stats)
+
+            if SNAPSHOT_FILE is None:
+                asyncio.run(stats.upload())
+            if failed:
+                print(f"{failed} series failed to upload")
+            # only rebuild on the first export
+            FULL_REBUILD = False
+            # keep the changes pending until they've been loaded
+            main_changed = synthetic_changed = False
+        # this includes errors from requests
+        except (subprocess.CalledProcessError, OSError) as e:
+            print(f"Export failed: {e}")
+            failed = True
+
+        if failed:
+            retry_delay = min(
+                WATCH_RETRY_MAX_DELAY,
+                WATCH_RETRY_DELAY if retry_delay is None else retry_delay * 2,
+            )
+            print(f"Retrying in {retry_delay:.0f}s")
+            deadline = time.monotonic() + retry_delay
         else:
-            requests.post(
-                f"{VICTORIAMETRICS_URI}/api/v1/import", json=json
-            ).raise_for_status()
-
-if not DRY_RUN:
-    requests.get(
-        f"{VICTORIAMETRICS_URI}/internal/resetRollupResultCache"
-    ).raise_for_status()
+            retry_delay = None
+            deadline = None
+
+        pending_main, pending_synthetic = main_changed, synthetic_changed
+        main_changed = synthetic_changed = False
+        while not (main_changed or synthetic_changed):
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - time.monotonic())
+            changed = inotify.wait(WATCH_DEBOUNCE, timeout)
+            if not changed:
+                break
+            main_changed = not changed.isdisjoint(map(os.path.abspath, main_files))
+            synthetic_changed = not changed.isdisjoint(
+                map(os.path.abspath, synthetic_files)
+            )
+        main_changed |= pending_main
+        synthetic_changed |= pending_synthetic
+        print("Journals changed" if changed else "Retrying")
+
+
+def main():
+    if WATCH:
+        watch()
+        return
+
+    stats = ExportStats()
+
+    with stats.stage("total"):
+        if REPLAY_FILE is None:
+            with stats.stage("load_journals"):
+                journals = load_journals_cached()
+            metrics = compute_metrics(journals, stats)
+        else:
+            metrics = read_snapshot(REPLAY_FILE)
+        failed = export(metrics, stats)
+
+    if SNAPSHOT_FILE is not None:
+        return
+
+    asyncio.run(stats.upload())
+
+    if failed:
+        sys.exit(f"{failed} series failed to upload")
+
+
+if __name__ == "__main__":
+    main()
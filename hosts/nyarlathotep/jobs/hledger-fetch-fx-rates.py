@@ -2,6 +2,8 @@
 
 from html.parser import HTMLParser
 
+import codecs
+import concurrent.futures
 import os
 import requests
 import sys
@@ -9,6 +11,19 @@ import time
 
 DRY_RUN = "--dry-run" in sys.argv
 
+# How long to wait for each page, in seconds: both for each read from the
+# socket and for the whole download
+FETCH_TIMEOUT = 30
+
+# How much of each page to parse at a time
+FETCH_CHUNK_SIZE = 16 * 1024
+
+# How many pages to fetch at once
+FETCH_THREADS = 8
+
+SESSION = requests.Session()
+SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=FETCH_THREADS))
+
 
 def get_financial_times(url):
     class PriceFinder(HTMLParser):
@@ -16,9 +31,39 @@ def get_financial_times(url):
             HTMLParser.__init__(self)
             self.found = None
             self.isnext = False
+            self.text = []
 
+        # the page is fed in chunks, so text can be split across several
+        # calls to `handle_data`: only look at it once it's complete.
         def handle_data(self, data):
-            if self.found is not None:
+            self.text.append(data)
+
+        def handle_starttag(self, tag, attrs):
+            self.handle_text()
+
+        def handle_endtag(self, tag):
+            self.handle_text()
+
+        def handle_comment(self, data):
+            self.handle_text()
+
+        def handle_decl(self, decl):
+            self.handle_text()
+
+        def handle_pi(self, data):
+            self.handle_text()
+
+        def unknown_decl(self, data):
+            self.handle_text()
+
+        def close(self):
+            HTMLParser.close(self)
+            self.handle_text()
+
+        def handle_text(self):
+            data = "".join(self.text)
+            self.text = []
+            if self.found is not None or not data:
                 return
 
             if data == "Price (GBP)":
@@ -27,10 +72,20 @@ def get_financial_times(url):
                 self.found = data
                 self.isnext = False
 
-    r = requests.get(url)
-    r.raise_for_status()
+    deadline = time.monotonic() + FETCH_TIMEOUT
     finder = PriceFinder()
-    finder.feed(r.text)
+    with SESSION.get(url, stream=True, timeout=FETCH_TIMEOUT) as r:
+        r.raise_for_status()
+        decoder = codecs.getincrementaldecoder(r.encoding or "utf-8")("replace")
+        for chunk in r.iter_content(FETCH_CHUNK_SIZE):
+            finder.feed(decoder.decode(chunk))
+            if finder.found is not None:
+                break
+            if time.monotonic() > deadline:
+                raise Exception("timed out")
+        else:
+            finder.feed(decoder.decode(b"", final=True))
+            finder.close()
     if finder.found is None:
         raise Exception("could not find price")
     else:
@@ -60,13 +115,15 @@ COMMODITIES = [
     ("VANEA", "GB00B41XG308", get_financial_times_fund),
 ]
 
+with concurrent.futures.ThreadPoolExecutor(FETCH_THREADS) as pool:
+    rates = [pool.submit(commodity[-1], commodity[-2]) for commodity in COMMODITIES]
+
 with sys.stdout if DRY_RUN else open(os.environ["PRICE_FILE"], "a") as f:
     print("", file=f)
 
-    for commodity in COMMODITIES:
+    for commodity, rate in zip(COMMODITIES, rates):
         symbol = commodity[0]
         try:
-            rate = commodity[-1](commodity[-2])
-            print(f"P {DATE} {symbol} £{rate}", file=f)
+            print(f"P {DATE} {symbol} £{rate.result()}", file=f)
         except Exception as e:
             print(f"; '{symbol}': {e}", file=f)
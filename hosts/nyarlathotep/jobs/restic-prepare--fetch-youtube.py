@@ -1,23 +1,65 @@
 #!/usr/bin/env python3
 
-"""Youtube "backup" script - generates a script to download videos."""
+"""Youtube "backup" script - generates a script to download videos.
 
+With `--batch`, generates a list of videos by directory for
+restic-restore--fetch-youtube instead of a shell script.
+"""
+
+import json
 import os
 import shlex
+import sys
 
 SOURCE_DIR = "/mnt/nas/misc/youtube"
 VIDEO_URL = "https://www.youtube.com/watch?v="
 
-print("#!/bin/sh")
-print("")
-
-for dirpath, dirnames, filenames in os.walk(SOURCE_DIR, topdown=True):
-    for dirname in dirnames:
-        print(f"mkdir {shlex.quote(os.path.join(dirpath, dirname))}")
-    for filename in filenames:
-        # filenames are of the form "title [id].ext"
-        name_pattern = filename.split("[")[-2] + "[%(id)s].%(ext)s"
-        url = VIDEO_URL + filename.split("[")[-1].split("]")[0]
-        print(
-            f"yt-dlp -P {shlex.quote(dirpath)} -o {shlex.quote(name_pattern)} {shlex.quote(url)}",
-        )
+# Output one JSON object per directory rather than a shell script
+BATCH = "--batch" in sys.argv
+
+
+def parse_filename(filename):
+    """Split a filename of the form "title [id].ext" into `(title prefix,
+    id)`, or return `None` if it's not of that form.
+    """
+
+    prefix, sep, rest = filename.rpartition("[")
+    if not sep:
+        return None
+    return (prefix, rest.partition("]")[0])
+
+
+def print_script():
+    """Print out `mkdir` and `yt-dlp` commands to download every video."""
+
+    print("#!/bin/sh")
+    print("")
+
+    for dirpath, dirnames, filenames in os.walk(SOURCE_DIR, topdown=True):
+        for dirname in dirnames:
+            print(f"mkdir {shlex.quote(os.path.join(dirpath, dirname))}")
+        for filename in filenames:
+            video = parse_filename(filename)
+            if video is None:
+                continue
+            prefix, video_id = video
+            name_pattern = prefix + "[%(id)s].%(ext)s"
+            print(
+                f"yt-dlp -P {shlex.quote(dirpath)} -o {shlex.quote(name_pattern)} {shlex.quote(VIDEO_URL + video_id)}",
+            )
+
+
+def print_batch():
+    """Print out `{"directory": dirpath, "videos": [[title prefix, id]]}`
+    for every directory, parents before children.
+    """
+
+    for dirpath, _, filenames in os.walk(SOURCE_DIR, topdown=True):
+        videos = [video for video in map(parse_filename, filenames) if video]
+        print(json.dumps({"directory": dirpath, "videos": videos}))
+
+
+if BATCH:
+    print_batch()
+else:
+    print_script()
@@ -2,11 +2,19 @@
 
 """Torrent "backup" script - generates a script to create the directory
 hierarchy and hardlink files.
+
+With `--compact`, generates a list for restic-restore--hardlink-torrent-files
+instead of a shell script.
 """
 
+import concurrent.futures
+import gzip
+import itertools
+import json
 import os
 import shlex
 import sys
+import time
 
 # Directories to link
 MEDIA_DIRS = ["/mnt/nas/anime", "/mnt/nas/movies", "/mnt/nas/tv"]
@@ -20,6 +28,18 @@ TORRENT_WATCH_DIR = "/mnt/nas/torrents/watch"
 # Only list unlinked files, don't generate a linking script
 CHECK_ONLY = "--check" in sys.argv
 
+# Output a compact NUL-separated list rather than a shell script
+COMPACT = "--compact" in sys.argv
+
+# Identifies the compact list format
+COMPACT_MAGIC = "hardlink-torrent-files 1"
+
+# Where to record the contents of every directory, so the next run only
+# needs to read the directories which have changed.  If unset, everything is
+# read every time.
+MANIFEST_FILE = os.getenv("MANIFEST_FILE")
+MANIFEST_VERSION = 1
+
 
 def print_cmd(cmd):
     """Print a command, if not in checking mode."""
@@ -35,37 +55,216 @@ def file_ref(fpath):
     return (info.st_dev, info.st_ino)
 
 
-def find_inodes(base):
-    """Return the set of inodes under the given base directory."""
+def load_manifest():
+    """Load the manifest saved by the previous run, or return an empty one."""
+
+    if MANIFEST_FILE is None:
+        return {}
+
+    try:
+        with gzip.open(MANIFEST_FILE, "rt", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if manifest.get("version") != MANIFEST_VERSION:
+        return {}
+    return manifest["trees"]
+
+
+def save_manifest(trees):
+    """Atomically write out the manifest for the next run."""
+
+    if MANIFEST_FILE is None:
+        return
+
+    tmp_file = f"{MANIFEST_FILE}.tmp"
+    with gzip.open(tmp_file, "wt", encoding="utf-8", compresslevel=1) as f:
+        json.dump({"version": MANIFEST_VERSION, "trees": trees}, f)
+    os.replace(tmp_file, MANIFEST_FILE)
+
+
+def scan(base, previous):
+    """Return `([(directory, [(filename, file_ref)])], manifest)` for every
+    directory under the given base directory, in the same order as
+    `os.walk`.
+
+    The manifest records each directory's mtime and entries.  A directory
+    whose mtime is the same as in the `previous` manifest hasn't had
+    anything added, removed, or renamed, so its entries are reused rather
+    than listed again.  Every directory still gets one `stat`, but only
+    changed directories are read.
+
+    Files take their inode from the directory listing and their device from
+    the directory they're in.  Symlinks are always followed again, as their
+    targets can change without the directory changing.
+    """
+
+    # don't trust the mtime of a directory changed just now, as it could
+    # change again within the filesystem's timestamp granularity
+    recent = time.time_ns() - 2 * 10**9
+
+    listing = []
+    manifest = {}
+
+    def read_entries(root):
+        # entries :: [[name, inode, or None for a symlink]]
+        # subdirs :: [name]
+        entries = []
+        subdirs = []
+        with os.scandir(root) as it:
+            for entry in it:
+                if entry.is_symlink():
+                    entries.append([entry.name, None])
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    subdirs.append(entry.name)
+                else:
+                    entries.append([entry.name, entry.inode()])
+        return {"entries": entries, "subdirs": subdirs}
+
+    def visit(root):
+        try:
+            info = os.stat(root)
+            record = previous.get(root)
+            if record is None or record["mtime"] != info.st_mtime_ns:
+                record = read_entries(root)
+        except OSError:
+            return
+
+        mtime = info.st_mtime_ns if info.st_mtime_ns < recent else None
+        manifest[root] = dict(record, mtime=mtime)
+
+        files = []
+        for name, inode in record["entries"]:
+            if inode is not None:
+                files.append((name, (info.st_dev, inode)))
+                continue
+            fpath = os.path.join(root, name)
+            if not os.path.isdir(fpath):
+                files.append((name, file_ref(fpath)))
+        listing.append((root, files))
+
+        for name in record["subdirs"]:
+            visit(os.path.join(root, name))
+
+    visit(base)
+    return (listing, manifest)
+
+
+def find_inodes(listing):
+    """Return the inodes in a directory listing."""
 
     inodes = dict()
-    for root, _, files in os.walk(base):
-        for fname in files:
-            fpath = os.path.join(root, fname)
-            inodes[file_ref(fpath)] = fpath
+    for root, files in listing:
+        for fname, ref in files:
+            inodes[ref] = os.path.join(root, fname)
     return inodes
 
 
-def traverse(base, inodes):
-    """Print out `mkdir` and `ln` commands to rebuild the directory / file
-    hierarchy under `base`, linking files to `inodes`.
+def traverse(listing, inodes):
+    """Yield `(directory, [(command, source_file, filename)])` for every
+    directory in a directory listing, where `command` is `"ln"` to link a
+    file to `inodes` or `"cp"` to copy a .torrent file.
     """
 
-    for root, _, files in os.walk(base):
-        print_cmd(f"mkdir {shlex.quote(root)}")
-        for fname in files:
+    for root, files in listing:
+        commands = []
+        for fname, ref in files:
             fpath = os.path.join(root, fname)
-            ref = file_ref(fpath)
             if ref in inodes:
-                source_file = inodes[ref]
-                print_cmd(f"ln {shlex.quote(source_file)} {shlex.quote(fpath)}")
+                commands.append(("ln", inodes[ref], fname))
             elif os.path.splitext(fpath)[-1] == ".torrent":
-                source_file = os.path.join(TORRENT_WATCH_DIR, fname)
-                print_cmd(f"cp {shlex.quote(source_file)} {shlex.quote(fpath)}")
+                commands.append(("cp", os.path.join(TORRENT_WATCH_DIR, fname), fname))
             else:
                 print(f"Unknown path {fpath}", file=sys.stderr)
+        yield (root, commands)
+
+
+def print_script(directories):
+    """Print out `mkdir`, `ln`, and `cp` commands to rebuild the directory /
+    file hierarchy.
+    """
+
+    for root, commands in directories:
+        print_cmd(f"mkdir {shlex.quote(root)}")
+        for command, source_file, fname in commands:
+            fpath = os.path.join(root, fname)
+            print_cmd(f"{command} {shlex.quote(source_file)} {shlex.quote(fpath)}")
+
+
+def print_compact(directories):
+    """Print out the directory / file hierarchy as a list of NUL-terminated
+    fields, after a header of the magic string and the torrent directories:
+
+        d <directory>            create a directory, and put files in it
+        s <source directory>     link files from this torrent subdirectory
+        l <source> <filename>    link a file from the source directory
+        c <filename>             copy a .torrent file from the watch directory
+
+    Source directories are relative to the torrent files directory, and a
+    directory's links are grouped by source directory, so each `s` field
+    covers as many links as possible.
+    """
+
+    out = sys.stdout.buffer
+
+    def field(value):
+        out.write(os.fsencode(value))
+        out.write(b"\0")
+
+    field(COMPACT_MAGIC)
+    field(TORRENT_FILES_DIR)
+    field(TORRENT_WATCH_DIR)
+
+    current_source_dir = None
+    for root, commands in directories:
+        field("d")
+        field(root)
+        links = []
+        for command, source_file, fname in commands:
+            if command == "ln":
+                source_dir, source_name = os.path.split(source_file)
+                source_dir = os.path.relpath(source_dir, TORRENT_FILES_DIR)
+                links.append((source_dir, source_name, fname))
+            else:
+                field("c")
+                field(fname)
+        links.sort(key=lambda link: (link[0] != current_source_dir, link[0]))
+        for source_dir, source_name, fname in links:
+            if source_dir != current_source_dir:
+                field("s")
+                field(source_dir)
+                current_source_dir = source_dir
+            field("l")
+            field(source_name)
+            field(fname)
+
+
+manifest = load_manifest()
+
+# the trees are on a NAS, so scan them all at once
+with concurrent.futures.ThreadPoolExecutor() as pool:
+    scans = {
+        base: pool.submit(scan, base, manifest.get(base, {}))
+        for base in [TORRENT_FILES_DIR] + MEDIA_DIRS
+    }
+
+listings = {}
+for base, future in scans.items():
+    listings[base], manifest[base] = future.result()
 
+save_manifest(manifest)
 
-inodes = find_inodes(TORRENT_FILES_DIR)
-for media_dir in MEDIA_DIRS:
-    traverse(media_dir, inodes)
+inodes = find_inodes(listings[TORRENT_FILES_DIR])
+directories = itertools.chain.from_iterable(
+    traverse(listings[media_dir], inodes) for media_dir in MEDIA_DIRS
+)
+if COMPACT and not CHECK_ONLY:
+    print_compact(directories)
+else:
+    print_script(directories)
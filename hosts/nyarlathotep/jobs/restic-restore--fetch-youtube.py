@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+"""Youtube restore script - downloads the videos listed by
+`restic-prepare--fetch-youtube --batch`.
+
+Usage: restic-restore--fetch-youtube.py <list file>
+
+Each directory's videos are passed to a single `yt-dlp -a` invocation, and
+several directories are downloaded at once.  Videos whose "[id]" is already
+in their directory are skipped, so an interrupted restore can just be run
+again.
+"""
+
+import concurrent.futures
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+VIDEO_URL = "https://www.youtube.com/watch?v="
+
+# How many directories to download at once
+RESTORE_JOBS = int(os.getenv("RESTORE_JOBS", "4"))
+
+# yt-dlp can't name each file in a batch differently, so download as
+# "id.ext" and then rename to "title [id].ext"
+DOWNLOAD_TEMPLATE = "%(id)s.%(ext)s"
+
+
+def existing_ids(dirpath):
+    """Return the ids of the videos already downloaded to a directory."""
+
+    ids = set()
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            _, sep, rest = entry.name.rpartition("[")
+            if sep:
+                ids.add(rest.partition("]")[0])
+    return ids
+
+
+def rename_downloads(dirpath, videos):
+    """Rename "id.ext" files to "title [id].ext"."""
+
+    prefixes = {video_id: prefix for prefix, video_id in videos}
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            video_id, sep, ext = entry.name.partition(".")
+            if sep and "." not in ext and video_id in prefixes:
+                new_name = f"{prefixes[video_id]}[{video_id}].{ext}"
+                os.rename(entry.path, os.path.join(dirpath, new_name))
+
+
+def download(dirpath, videos):
+    """Download the missing videos in a directory, returning whether
+    `yt-dlp` succeeded.
+    """
+
+    done = existing_ids(dirpath)
+    videos = [video for video in videos if video[1] not in done]
+    if not videos:
+        return True
+
+    with tempfile.NamedTemporaryFile("w", suffix=".txt") as batch_file:
+        for _, video_id in videos:
+            batch_file.write(f"{VIDEO_URL}{video_id}\n")
+        batch_file.flush()
+
+        result = subprocess.run(
+            ["yt-dlp", "-P", dirpath, "-o", DOWNLOAD_TEMPLATE, "-a", batch_file.name],
+            stdout=subprocess.DEVNULL,
+        )
+
+    rename_downloads(dirpath, videos)
+    if result.returncode != 0:
+        print(f"yt-dlp failed in {dirpath}", file=sys.stderr)
+    return result.returncode == 0
+
+
+if len(sys.argv) != 2:
+    print(f"usage: {sys.argv[0]} <list file>", file=sys.stderr)
+    sys.exit(2)
+
+with open(sys.argv[1]) as f:
+    directories = [json.loads(line) for line in f]
+
+for directory in directories:
+    os.makedirs(directory["directory"], exist_ok=True)
+
+with concurrent.futures.ThreadPoolExecutor(RESTORE_JOBS) as pool:
+    results = pool.map(
+        lambda directory: download(directory["directory"], directory["videos"]),
+        directories,
+    )
+    failures = sum(not ok for ok in results)
+
+if failures:
+    print(f"{failures} directories failed", file=sys.stderr)
+    sys.exit(1)
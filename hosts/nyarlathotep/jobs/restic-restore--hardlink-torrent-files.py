@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""Torrent restore script - recreates the directory hierarchy and hardlinks
+from the list generated by `restic-prepare--hardlink-torrent-files --compact`.
+
+Usage: restic-restore--hardlink-torrent-files.py <list file>
+
+Directories are created first, in order, and then the files in each
+directory are linked by a pool of threads.  Files which have already been
+linked are skipped, so an interrupted restore can just be run again.
+"""
+
+import concurrent.futures
+import os
+import shutil
+import sys
+
+# How many directories to link files into at once
+RESTORE_THREADS = int(os.getenv("RESTORE_THREADS", "16"))
+
+# Identifies the compact list format
+COMPACT_MAGIC = "hardlink-torrent-files 1"
+
+
+def read_list(fname):
+    """Parse a compact list into `[(directory, [(command, source_file,
+    target_file)])]`.
+    """
+
+    with open(fname, "rb") as f:
+        fields = f.read().split(b"\0")
+    if fields.pop() != b"":
+        raise ValueError(f"{fname} is truncated")
+    fields = iter(map(os.fsdecode, fields))
+
+    if next(fields, None) != COMPACT_MAGIC:
+        raise ValueError(f"{fname} is not a {COMPACT_MAGIC} list")
+    torrent_files_dir = next(fields)
+    torrent_watch_dir = next(fields)
+
+    directories = []
+    source_dir = None
+    for tag in fields:
+        if tag == "d":
+            root = next(fields)
+            commands = []
+            directories.append((root, commands))
+        elif tag == "s":
+            source_dir = os.path.join(torrent_files_dir, next(fields))
+        elif tag == "l":
+            source_name = next(fields)
+            fname = next(fields)
+            commands.append(
+                ("ln", os.path.join(source_dir, source_name), os.path.join(root, fname))
+            )
+        elif tag == "c":
+            fname = next(fields)
+            commands.append(
+                (
+                    "cp",
+                    os.path.join(torrent_watch_dir, fname),
+                    os.path.join(root, fname),
+                )
+            )
+        else:
+            raise ValueError(f"unexpected field {tag!r}")
+    return directories
+
+
+def restore_files(commands):
+    """Link or copy files, returning the number of failures."""
+
+    failures = 0
+    for command, source_file, target_file in commands:
+        try:
+            if command == "ln":
+                try:
+                    os.link(source_file, target_file)
+                except FileExistsError:
+                    if not os.path.samefile(source_file, target_file):
+                        raise
+            elif not os.path.exists(target_file):
+                shutil.copy(source_file, target_file)
+        except OSError as e:
+            print(f"{command} {source_file} {target_file}: {e}", file=sys.stderr)
+            failures += 1
+    return failures
+
+
+if len(sys.argv) != 2:
+    print(f"usage: {sys.argv[0]} <list file>", file=sys.stderr)
+    sys.exit(2)
+
+directories = read_list(sys.argv[1])
+
+failures = 0
+for root, _ in directories:
+    try:
+        os.makedirs(root, exist_ok=True)
+    except OSError as e:
+        print(f"mkdir {root}: {e}", file=sys.stderr)
+        failures += 1
+
+with concurrent.futures.ThreadPoolExecutor(RESTORE_THREADS) as pool:
+    failures += sum(pool.map(restore_files, (cmds for _, cmds in directories)))
+
+if failures:
+    print(f"{failures} failures", file=sys.stderr)
+    sys.exit(1)